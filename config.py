@@ -6,7 +6,8 @@ from itertools import cycle
 from collections import Iterator
 
 import const
-from image_manager import ImageManager, FrameImage, FileImage, PartsImage
+from image_manager import (ImageManager, FrameImage, FileImage, PartsImage, LayerCache, SparseLayer,
+                           ClipperGraph, TransactionState, FrameSequence)
 import editor
 
 TYPE = "_type"
@@ -38,6 +39,10 @@ class InstantEncoder(json.JSONEncoder):
             return None
         elif isinstance(obj, cycle):
             return None
+        elif isinstance(obj, (LayerCache, SparseLayer, ClipperGraph, TransactionState)):
+            return None
+        elif isinstance(obj, FrameSequence):
+            return list(obj)
         elif isinstance(obj, Iterator):
             return None
         else:
@@ -83,8 +88,10 @@ class Config:
         self.manager = ImageManager()
         self.dir_dialog = None
 
+    # 操作中の低品質な画像を保存しないよう、呼ぶ前にUIのスレッドでend_interactionしておくこと
+    # 保存のスレッドから呼ばれるため、書き出す間はUIのスレッドの変更を待たせる
     def save_manager(self, path_save):
-        with open(path_save, "w") as f:
+        with self.manager.state_transaction.reading(), open(path_save, "w") as f:
             json.dump(self.manager, f, cls=InstantEncoder, ensure_ascii=False, indent=4)
 
     def load_manager(self, path_json):
@@ -98,7 +105,15 @@ class Config:
         with open(path_json, "r") as f:
             manager = json.load(f, cls=InstantDecoder)
 
-        self.manager = manager
+        # 読込前のマネージャーに登録された変更通知先を引き継ぐ
+        for listener in self.manager.state_transaction.listeners:
+            manager.add_listener(listener)
+
+        # 描画中のスレッドが使い終わってから手放す
+        with self.manager.state_transaction.lock:
+            self.manager.close()
+            self.manager = manager
+
         return True, "読込が完了しました！"
 
     def check_json(self, dic_json):
@@ -3,7 +3,6 @@ import win32api
 import sys
 import pathlib
 from dataclasses import dataclass, fields
-import wx
 from wx.lib.newevent import NewEvent
 from PIL import Image
 import numpy as np
@@ -128,6 +127,26 @@ class SaveMode:
 MODES_SAVE = [field.default for field in fields(SaveMode)]
 THRESHOLD_CONVERT_SINGLE = 0.25
 
+
+# 合成処理の実装 PILは検証用
+@dataclass
+class CompositeEngine:
+    NUMPY: str = "numpy"
+    PIL: str = "pil"
+
+
+ENGINE_COMPOSITE = CompositeEngine.NUMPY
+# 保存時にフレーム合成を別プロセスへ振り分けるフレーム数
+MIN_FRAMES_PARALLEL = 4
+# 変形済み画像をファイル・フレーム間で共有するキャッシュの上限(byte)
+LIMIT_CACHE_TRANSFORM = 256 * 1024 * 1024
+# 対話的な操作が止まってから高品質で描画し直すまでの時間(ms)
+DELAY_IDLE_RENDER = 300
+# フレーム列をメモリに置く上限(byte) 超える分は一時ファイルのmemmapに置く
+LIMIT_FRAMES_RAM = 64 * 1024 * 1024
+# ファイルから読み込んだフレームをデコード済みのまま持っておく枚数
+LIMIT_CACHE_FRAMES = 16
+
 # フォルダパス
 FOLDER_DATA = pathlib.Path(sys.prefix + "/Data")
 FOLDER_IMAGE = FOLDER_DATA / "Image"
@@ -169,10 +188,6 @@ BG_PHOTO = Image.open(PATH_BG_PHOTO).convert("RGBA")
 BG_FILE = Image.open(PATH_BG_FILE).convert("RGBA")
 BG_PARTS = Image.open(PATH_BG_PARTS).convert("RGBA")
 BG_UNSELECTED = Image.open(PATH_BG_UNSELECTED).convert("RGBA")
-BMP_UNSELECTED = wx.Bitmap.FromBufferRGBA(*BG_UNSELECTED.size, BG_UNSELECTED.tobytes())
-
-BMP_MACHAN = Image.open(PATH_MACHAN).convert("RGBA")
-BMP_MACHAN = wx.Bitmap.FromBufferRGBA(*BMP_MACHAN.size, BMP_MACHAN.tobytes())
 
 # 加工画像パス
 PATH_GIF_PREVIEW = FOLDER_MATERIAL / "preview.gif"
@@ -182,7 +197,6 @@ PATH_MASK_FACE = FOLDER_MATERIAL / "mask_face.png"
 # フォント
 PATH_FONT_GENEI = FOLDER_DATA / "Font/GenEiNuGothic-EB_v1.1/GenEiNuGothic-EB.ttf"
 FACE_FONT_GENEI = "源暎Nuゴシック EB"
-wx.Font.AddPrivateFont(str(PATH_FONT_GENEI))
 
 # 取り込める拡張子
 SUFFIXES_IMAGE = [".jpg", ".jpeg", ".png", ".gif",
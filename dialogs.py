@@ -9,6 +9,7 @@ from natsort import os_sorted
 
 import const
 from config import CONFIG
+from image_manager import STORE_ICON
 import wxlib
 import widgets
 import editor
@@ -224,7 +225,7 @@ class ClipperSelectDialog(wx.Dialog):
         self.lst_image.remove(image_target)
         self.lst_unclipper = []
         self.lst_clipper = []
-        self.imagelist, self.order_il = self.create_imagelist()
+        self.imagelist = STORE_ICON.get_imagelist()
 
         self.lc_unclipper = wx.ListCtrl(self.panel, -1, style=wx.LC_SMALL_ICON)
         self.lc_clipper = wx.ListCtrl(self.panel, -1, style=wx.LC_SMALL_ICON)
@@ -299,20 +300,11 @@ class ClipperSelectDialog(wx.Dialog):
 
         for ix, image in enumerate(self.lst_unclipper):
             label = image.label + "　" * (15 - len(image.label))
-            item = self.lc_unclipper.InsertItem(ix, label, self.order_il.index(image.id_file))
+            item = self.lc_unclipper.InsertItem(ix, label, image.get_ix_icon())
 
         for ix, clipper in enumerate(self.lst_clipper):
             label = clipper.label + "　" * (15 - len(clipper.label))
-            item = self.lc_clipper.InsertItem(ix, label, self.order_il.index(clipper.id_file))
-
-    def create_imagelist(self):
-        imagelist = wx.ImageList(*const.ICON_SIZE)
-        order_il = []
-        for image in self.lst_image:
-            imagelist.Add(image.get_bmp_icon())
-            order_il.append(image.id_file)
-
-        return imagelist, order_il
+            item = self.lc_clipper.InsertItem(ix, label, clipper.get_ix_icon())
 
     def on_click(self, event):
         lc = event.GetEventObject()
@@ -324,7 +316,10 @@ class ClipperSelectDialog(wx.Dialog):
         if lc == self.lc_unclipper:
             clipper = self.lst_unclipper[ix_selected]
             id_clipper = clipper.id_file if self.is_file else clipper.id_parts
-            CONFIG.manager.add_clipper(self.id_image, id_clipper)
+            if not CONFIG.manager.add_clipper(self.id_image, id_clipper):
+                message = f"{clipper.label}は{self.st_label.GetLabel()}でクリップされているため、クリッパーに設定できません！"
+                wxlib.show_message(self, message, "クリッパー循環", wx.ICON_EXCLAMATION)
+                return
 
         else:
             clipper = self.lst_clipper[ix_selected]
@@ -6,6 +6,7 @@ import cv2
 import numpy as np
 import math
 import base64
+import hashlib
 
 from itertools import cycle
 import const
@@ -156,6 +157,43 @@ def replace_color_hsv(image, color_target, color_replace):
     return image_replace
 
 
+# 全フレームで画素のある範囲の和 元のキャンバスサイズと合わせて返す 全て透明ならキャンバス全体
+def get_box_trim(frames):
+    size_source, box_trim = None, None
+    for frame in frames:
+        size_source = size_source or frame.size
+        bbox = frame.convert("RGBA").getchannel("A").getbbox()
+        if bbox is None:
+            continue
+
+        box_trim = bbox if box_trim is None else (min(box_trim[0], bbox[0]), min(box_trim[1], bbox[1]),
+                                                  max(box_trim[2], bbox[2]), max(box_trim[3], bbox[3]))
+
+    return size_source, box_trim or (0, 0, *size_source)
+
+
+# デコードしたフレームを保持する形にする 半透明が無く256色に収まれば0番を透明としたパレット画像、それ以外はRGBA
+# 色はRGBAをuint32にした値で探す 透明な画素はアルファが0のため不透明などの色よりも小さく、全て0番になる
+def convert_frame(im):
+    im = im.convert("RGBA")
+    colors = im.getcolors(256)
+    if colors is None or any(0 < color[3] < 255 for _, color in colors):
+        return im
+
+    nd_keys = np.array(sorted({int.from_bytes(bytes(color), "little") for _, color in colors
+                               if color[3] == 255}), np.uint32)
+    if len(nd_keys) > 255:
+        return im
+
+    nd_keys = np.concatenate((np.zeros(1, np.uint32), nd_keys))
+    nd_color = np.asarray(im).view(np.uint32)[..., 0]
+    nd_index = (np.searchsorted(nd_keys, nd_color, "right") - 1).astype(np.uint8)
+    im_index = Image.fromarray(nd_index, "P")
+    im_index.putpalette(nd_keys.view(np.uint8).reshape(-1, 4)[:, :3].tobytes())
+    im_index.info["transparency"] = 0
+    return im_index
+
+
 # サムネイルアイコン作成
 # size_icon:アイコンサイズ,size_thumb:アイコンに張り付けるサムネイルサイズ
 def create_icon(im, size_icon, size_thumb=None, bg=None, alignment="Center"):
@@ -200,7 +238,24 @@ def draw_text(im, text, size, path_font, color, bbox):
 
 
 # チェス盤作成
+# プレビューごとに作り直さないようサイズと配色ごとに保持する 呼び出し側で書き換えないこと
+DIC_CHESS_BOARD = {}
+LIMIT_CHESS_BOARD = 8
+
+
 def create_chess_board(size, selected_file=True):
+    key = (tuple(int(dim) for dim in size), selected_file)
+    image_chess = DIC_CHESS_BOARD.get(key)
+    if image_chess is None:
+        if len(DIC_CHESS_BOARD) >= LIMIT_CHESS_BOARD:
+            DIC_CHESS_BOARD.clear()
+
+        image_chess = DIC_CHESS_BOARD.setdefault(key, draw_chess_board(*key))
+
+    return image_chess
+
+
+def draw_chess_board(size, selected_file):
     width, height = size
     white_file = np.array((200, 210, 200), dtype=np.uint8)
     white_parts = np.array((200, 200, 215), dtype=np.uint8)
@@ -221,6 +276,20 @@ def create_chess_board(size, selected_file=True):
     return image_chess
 
 
+# 市松模様の上に画像を重ねる bufferに同じサイズの画像を渡すとそこへ書き込んで使い回す
+def composite_chess_board(im, selected_file=True, buffer=None):
+    image_chess = create_chess_board(im.size, selected_file)
+    if buffer is None or buffer.size != im.size or buffer.mode != "RGBA":
+        buffer = image_chess.copy()
+    else:
+        buffer.paste(image_chess)
+
+    # 不透明な背景へのマスク付き貼り付けはalpha_compositeと同じ結果になる
+    buffer.paste(im, (0, 0), im)
+    buffer.putalpha(255)
+    return buffer
+
+
 # 指定のポイントに表示されている画素があるか
 def collide_point(im, point):
     x, y = point
@@ -234,6 +303,93 @@ def collide_point(im, point):
     return bool(alpha_pixel)
 
 
+# 直角の回転角と転置の対応
+DIC_TRANSPOSE = {90.0: Image.ROTATE_90, 180.0: Image.ROTATE_180, 270.0: Image.ROTATE_270}
+
+
+# transform_imageで補間が入るかどうか 反転と直角の回転だけなら画質の指定は結果に関わらない
+def is_interpolated(size, zoom_x, zoom_y, angle):
+    width, height = size
+    angle = float(angle) % 360.0
+    return ((int(width * zoom_x), int(height * zoom_y)) != (width, height) or
+            (angle != 0 and angle not in DIC_TRANSPOSE))
+
+
+# 反転・拡大縮小・回転を1回のアフィン変換でまとめて行う
+# 出力の大きさと向きはPILのrotate(expand=True)と同じ 色の補間は乗算済みアルファで行う
+def transform_image(im, zoom_x, zoom_y, angle, is_flip, draft=False):
+    # パレットで持っている素材はここで初めてRGBAに展開する
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+
+    width, height = im.size
+    width_zoom, height_zoom = int(width * zoom_x), int(height * zoom_y)
+    angle = float(angle) % 360.0
+
+    # 拡大縮小も回転もない場合は補間せずに反転だけを行う
+    if (width_zoom, height_zoom) == (width, height) and angle == 0:
+        return ImageOps.mirror(im.convert("RGBA")) if is_flip else im.convert("RGBA")
+
+    # 直角の回転はPILのrotateと同じく拡大縮小の後に転置する 補間のずれも寸法のずれも出ない
+    if angle in DIC_TRANSPOSE:
+        im_zoom = transform_image(im, zoom_x, zoom_y, 0, is_flip, draft)
+        return im_zoom.transpose(DIC_TRANSPOSE[angle])
+
+    # 縮小はワープだけだと折り返しノイズが出るため先に面積平均で縮める
+    nd_src = np.asarray(im.convert("RGBa"))
+    width_src, height_src = min(width, width_zoom), min(height, height_zoom)
+    if (width_src, height_src) != (width, height):
+        nd_src = cv2.resize(nd_src, (width_src, height_src), interpolation=cv2.INTER_AREA)
+
+    # PILのrotateと同じ 出力座標から拡大後の画像座標への逆変換
+    rad = -math.radians(angle)
+    cos, sin = round(math.cos(rad), 15), round(math.sin(rad), 15)
+    nd_rotate = np.array([[cos, sin], [-sin, cos]])
+    nd_center = np.array((width_zoom / 2.0, height_zoom / 2.0))
+    nd_shift = nd_rotate @ -nd_center + nd_center
+    nd_corners = np.array(((0, 0), (width_zoom, 0), (width_zoom, height_zoom), (0, height_zoom)))
+    nd_corners = nd_corners @ nd_rotate.T + nd_shift
+    width_out = math.ceil(nd_corners[:, 0].max()) - math.floor(nd_corners[:, 0].min())
+    height_out = math.ceil(nd_corners[:, 1].max()) - math.floor(nd_corners[:, 1].min())
+    nd_expand = np.array((width_out - width_zoom, height_out - height_zoom)) / 2.0
+    nd_shift = nd_rotate @ -nd_expand + nd_shift
+
+    # 画素中心の座標に直し、拡大後の画像座標から元画像の座標へ縮尺と反転を合成する
+    scale_x, scale_y = width_src / width_zoom, height_src / height_zoom
+    nd_shift = nd_rotate @ np.array((0.5, 0.5)) + nd_shift
+    nd_matrix = np.zeros((2, 3))
+    nd_matrix[:, :2] = np.diag((scale_x, scale_y)) @ nd_rotate
+    nd_matrix[:, 2] = np.diag((scale_x, scale_y)) @ nd_shift - 0.5
+    if is_flip:
+        nd_matrix[0] = -nd_matrix[0]
+        nd_matrix[0, 2] += width_src - 1
+
+    interpolation = cv2.INTER_LINEAR if draft else cv2.INTER_CUBIC
+    nd_edit = cv2.warpAffine(nd_src, nd_matrix, (width_out, height_out),
+                             flags=interpolation | cv2.WARP_INVERSE_MAP,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+    im_edit = Image.fromarray(nd_edit, "RGBa").convert("RGBA")
+    return im_edit
+
+
+# 画素が同じ画像を同じ値にするハッシュ
+def get_fingerprint(im):
+    hash_im = hashlib.blake2b(im.tobytes(), digest_size=16)
+    # パレット画像は番号が同じでも色が違うことがある
+    if im.mode == "P":
+        hash_im.update(bytes(im.getpalette() or []))
+
+    return hash_im.hexdigest(), im.size, im.mode
+
+
+# 透過度の分だけアルファを下げる LUTで一度に掛ける
+def apply_transparency(im, transparency):
+    lut_trans = [int(np.clip(a - transparency, 0, 255)) for a in range(256)]
+    im_trans = im.copy()
+    im_trans.putalpha(im.split()[-1].point(lut_trans))
+    return im_trans
+
+
 # カラーブレンド
 def multiply_color(image, color, *args):
     alpha = image.split()[-1]
@@ -551,25 +707,18 @@ def get_frames(path_image):
     return frames
 
 
-def draw_selection_marker(im, color_outline):
-    color_out_line_bgr = [color_outline[ix] for ix in [2, 1, 0]]
-    alpha = im.convert("RGBA").split()[-1]
-    nd_campus = cv2.cvtColor(np.array(im.convert("RGBA"), np.uint8), cv2.COLOR_RGB2BGR)
-    nd_alpha = np.array(alpha, np.uint8)
-
-    retval, nd_thresh = cv2.threshold(nd_alpha, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    cnts, _ = cv2.findContours(nd_alpha, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    for cnt in cnts:
-        cv2.drawContours(nd_campus, [cnt], 0, color_out_line_bgr, 5)
-        cv2.drawContours(nd_alpha, [cnt], 0, (255, 255, 255), 5)
-
-    nd_campus = cv2.cvtColor(nd_campus, cv2.COLOR_BGR2RGB)
-    im_marked = Image.fromarray(nd_campus).convert("RGBA")
-    alpha_outline = Image.fromarray(nd_alpha)
-    alpha_clip = Image.eval(alpha, lambda e: 0 if e == 0 else 255)
-    alpha_outline = ImageChops.darker(alpha_clip, alpha_outline)
-    im_marked.putalpha(alpha_outline)
-    return im_marked
+# 選択マーカー用の外側の輪郭の内側の帯 輪郭からwidth_band画素の範囲
+def get_mask_outline(im, width_band=3):
+    nd_alpha = np.array(im.split()[-1], np.uint8)
+    nd_shape = np.where(nd_alpha > 0, 255, 0).astype(np.uint8)
+    # 穴は埋めて外側の輪郭だけを帯にする
+    cnts, _ = cv2.findContours(nd_shape, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    nd_fill = np.zeros_like(nd_shape)
+    cv2.drawContours(nd_fill, cnts, -1, 255, cv2.FILLED)
+    kernel = np.ones((width_band * 2 + 1, width_band * 2 + 1), np.uint8)
+    nd_inner = cv2.erode(nd_fill, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    nd_band = cv2.bitwise_and(cv2.subtract(nd_fill, nd_inner), nd_shape)
+    return Image.fromarray(nd_band)
 
 
 def clip_by_images(im, clippers):
@@ -588,6 +737,13 @@ def clip_by_images(im, clippers):
 
 
 def apply_anti_alias(campus_origin, campus_smooth, im_inner, im_outer=None):
+    mask_edge = get_mask_edge(im_inner, im_outer)
+    campus_smooth.putalpha(mask_edge)
+    campus_alias = Image.alpha_composite(campus_origin, campus_smooth)
+    return campus_alias
+
+
+def get_mask_edge(im_inner, im_outer=None):
     alpha = im_inner.split()[-1]
     mask_edge = (alpha.filter(ImageFilter.FIND_EDGES).convert("L")
                  .filter(ImageFilter.GaussianBlur(0.75)))
@@ -596,9 +752,48 @@ def apply_anti_alias(campus_origin, campus_smooth, im_inner, im_outer=None):
         alpha_outer = im_outer.split()[-1]
         mask_edge = ImageChops.darker(mask_edge, alpha_outer)
 
-    campus_smooth.putalpha(mask_edge)
-    campus_alias = Image.alpha_composite(campus_origin, campus_smooth)
-    return campus_alias
+    return mask_edge
+
+
+# bboxをmargin分広げてキャンバス内に収める
+def pad_bbox(bbox, margin, size):
+    left, top, right, bottom = bbox
+    width, height = size
+    return (max(left - margin, 0), max(top - margin, 0),
+            min(right + margin, width), min(bottom + margin, height))
+
+
+# 乗算済みアルファの作業用キャンバス(高さ,幅,RGBA)
+def create_campus_premultiplied(size):
+    width, height = size
+    return np.zeros((height, width, 4), np.float32)
+
+
+# bboxの範囲だけをキャンバスに直接合成する alphaを与えた場合は画像のアルファの代わりに使う
+def composite_premultiplied(campus, im, bbox, alpha=None):
+    left, top, right, bottom = bbox
+    if left >= right or top >= bottom:
+        return campus
+
+    nd_src = np.asarray(im.crop(bbox), np.float32) / 255
+    nd_alpha = (nd_src[..., 3:] if alpha is None else
+                np.asarray(alpha.crop(bbox), np.float32)[..., np.newaxis] / 255)
+    region = campus[top:bottom, left:right]
+    region *= 1 - nd_alpha
+    region[..., :3] += nd_src[..., :3] * nd_alpha
+    region[..., 3:] += nd_alpha
+    return campus
+
+
+def convert_premultiplied(campus, alpha=None):
+    nd_alpha = campus[..., 3:]
+    nd_rgb = np.divide(campus[..., :3], nd_alpha, out=np.ones_like(campus[..., :3]),
+                       where=nd_alpha > 0)
+    nd_image = np.empty(campus.shape, np.uint8)
+    nd_image[..., :3] = np.clip(nd_rgb * 255 + 0.5, 0, 255)
+    nd_image[..., 3] = (np.clip(nd_alpha[..., 0] * 255 + 0.5, 0, 255) if alpha is None else
+                        np.asarray(alpha, np.uint8))
+    return Image.fromarray(nd_image, "RGBA")
 
 
 def clip_for_costume(path_image, frames):
@@ -716,7 +911,7 @@ def separate_contours(frame, trim, area_omit):
 
 
 def encode_image(im):
-    nd_im = np.array(im)
+    nd_im = np.array(im.convert("RGBA"))
     nd_im = cv2.cvtColor(nd_im, cv2.COLOR_RGBA2BGRA)
     _, enc_im = cv2.imencode(".png", nd_im)
     bytes_im = enc_im.tobytes()
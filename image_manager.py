@@ -1,9 +1,18 @@
-from PIL import Image, ImageSequence, ImageOps, ImageFilter, UnidentifiedImageError
+from PIL import Image, ImageFilter, ImageChops, UnidentifiedImageError
 import numpy as np
 from itertools import cycle
 import wx
+import io
+import os
 import pathlib
-from dataclasses import dataclass, field
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import const
 import editor
@@ -11,8 +20,451 @@ import editor
 import time
 
 
+# 新しい描画要求に追い越された合成を途中で打ち切る
+class RenderCancelled(Exception):
+    pass
+
+
+def check_cancel(cancel):
+    if cancel is not None and cancel():
+        raise RenderCancelled
+
+
+# パーツ状態をキーにした生成物のキャッシュ
+# キーにはidを使うため、キー元のオブジェクトはrefsとして保持しておきidの再利用を防ぐ
+class LayerCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, key):
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != key:
+            return None
+
+        return entry[1]
+
+    def put(self, name, key, value, refs=()):
+        self.entries[name] = (key, value, refs)
+        return value
+
+    def clear(self):
+        self.entries = {}
+
+
+# 変形済み画像をプロセス全体で共有するLRUキャッシュ 画像の合計バイト数で上限を決める
+# 同じ素材から作られた別フレームのパーツが同じ変形をするときは1回で済む
+class TransformCache:
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+
+            return image
+
+    def put(self, key, image):
+        size_bytes = image.width * image.height * len(image.getbands())
+        with self.lock:
+            if key in self.entries or size_bytes > self.limit_bytes:
+                return image
+
+            self.entries[key] = image
+            self.total_bytes += size_bytes
+            while self.total_bytes > self.limit_bytes:
+                _, image_old = self.entries.popitem(last=False)
+                self.total_bytes -= image_old.width * image_old.height * len(image_old.getbands())
+
+        return image
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.total_bytes = 0
+
+
+CACHE_TRANSFORM = TransformCache(const.LIMIT_CACHE_TRANSFORM)
+
+
+# アイコンの共有置き場 内容が同じアイコンは1つにまとめてwx.Bitmapとイメージリストの番号も使い回す
+# 各フレームの同じパーツは元画像が同じなのでサムネイル作成も1回で済む
+class IconStore:
+    def __init__(self):
+        self.dic_icon = {}
+        self.dic_key = {}
+        self.dic_bmp = {}
+        self.dic_ix = {}
+        self.imagelist = None
+        self.lock = threading.Lock()
+
+    # fingerprintは元画像の指紋 作成条件と合わせてキーにする
+    def create_icon(self, fingerprint, im, size_icon, size_thumb=None, bg=None, alignment="Center"):
+        key = (fingerprint, size_icon, size_thumb, id(bg), alignment)
+        with self.lock:
+            icon = self.dic_icon.get(key)
+
+        if icon is None:
+            icon = editor.create_icon(im, size_icon, size_thumb, bg, alignment)
+            with self.lock:
+                icon = self.dic_icon.setdefault(key, icon)
+
+        return icon
+
+    # アイコン自体の指紋 キーにidを使うためアイコンも保持しておく
+    def get_key(self, icon):
+        entry = self.dic_key.get(id(icon))
+        if entry is None:
+            entry = self.dic_key[id(icon)] = (icon, editor.get_fingerprint(icon))
+
+        return entry[1]
+
+    def get_bitmap(self, icon):
+        key = self.get_key(icon)
+        bmp = self.dic_bmp.get(key)
+        if bmp is None:
+            bmp = self.dic_bmp[key] = wx.Bitmap.FromBufferRGBA(*icon.size, icon.tobytes())
+
+        return bmp
+
+    # 一覧・ツリー・ダイアログで共有するイメージリスト 追加のみで番号は変わらない
+    def get_imagelist(self):
+        if self.imagelist is None:
+            self.imagelist = wx.ImageList(*const.ICON_SIZE)
+
+        return self.imagelist
+
+    def get_ix(self, icon):
+        key = self.get_key(icon)
+        ix = self.dic_ix.get(key)
+        if ix is None:
+            ix = self.dic_ix[key] = self.get_imagelist().Add(self.get_bitmap(icon))
+
+        return ix
+
+    # 使われなくなったアイコンを捨てる イメージリストは使われていない番号が使われている番号より多くなったら作り直す
+    # 作り直した場合はTrueを返す clearと同じく使う側も表示を作り直すこと
+    def prune(self, icons_alive):
+        ids_alive = {id(icon) for icon in icons_alive}
+        with self.lock:
+            self.dic_icon = {key: icon for key, icon in self.dic_icon.items() if id(icon) in ids_alive}
+
+        self.dic_key = {id_icon: entry for id_icon, entry in self.dic_key.items() if id_icon in ids_alive}
+        keys_alive = {key for _, key in self.dic_key.values()}
+        self.dic_bmp = {key: bmp for key, bmp in self.dic_bmp.items() if key in keys_alive}
+        count_dead = len(self.dic_ix.keys() - keys_alive)
+        if count_dead <= len(self.dic_ix) - count_dead:
+            return False
+
+        self.dic_ix = {}
+        self.imagelist.RemoveAll()
+        return True
+
+    # イメージリストの番号が振り直しになるため、使う側も表示を作り直すこと
+    def clear(self):
+        with self.lock:
+            self.dic_icon = {}
+
+        self.dic_key = {}
+        self.dic_bmp = {}
+        self.dic_ix = {}
+        if self.imagelist is not None:
+            self.imagelist.RemoveAll()
+
+
+STORE_ICON = IconStore()
+
+
+# フレームの列 番号・スライス・負の番号で取り出せる 取り出し方はget_frameで決める
+class FrameSequence:
+    number_frames = 0
+
+    def __len__(self):
+        return self.number_frames
+
+    def __bool__(self):
+        return self.number_frames > 0
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(self.number_frames))]
+
+        if ix < 0:
+            ix += self.number_frames
+
+        if not 0 <= ix < self.number_frames:
+            raise IndexError(ix)
+
+        return self.get_frame(ix)
+
+    def __iter__(self):
+        return (self[ix] for ix in range(self.number_frames))
+
+    def get_frame(self, ix):
+        raise NotImplementedError
+
+
+# フレームを(N, H, W, 4)のuint8配列1つにまとめて持つ列 大きいものは一時ファイルのmemmapに置く
+# PIL画像は取り出す時にframebufferで配列を共有して作るためコピーは発生しない
+class FrameStack(FrameSequence):
+    def __init__(self, number_frames, size, limit_ram=const.LIMIT_FRAMES_RAM):
+        width, height = size
+        shape = (number_frames, height, width, 4)
+        self.size = (width, height)
+        self.number_frames = number_frames
+        self.file_temp = None
+        if np.prod(shape) > limit_ram:
+            self.file_temp = tempfile.TemporaryFile()
+            self.nd_frames = np.memmap(self.file_temp, np.uint8, "w+", shape=shape)
+        else:
+            self.nd_frames = np.zeros(shape, np.uint8)
+
+    def get_frame(self, ix):
+        return Image.frombuffer("RGBA", self.size, self.nd_frames[ix], "raw", "RGBA", 0, 1)
+
+
+# サイズの揃ったフレームのリストを1つの配列にまとめる 揃っていなければNone
+# box_trimがあればその範囲に切り詰める
+def create_frame_stack(frames, box_trim=None):
+    if len({frame.size for frame in frames}) != 1:
+        return None
+
+    left, top, right, bottom = box_trim or (0, 0, *frames[0].size)
+    stack = FrameStack(len(frames), (right - left, bottom - top))
+    for ix, frame in enumerate(frames):
+        stack.nd_frames[ix] = np.asarray(frame.convert("RGBA").crop((left, top, right, bottom)))
+
+    return stack
+
+
+# 画像ファイルのフレーム列 アクセスされたフレームだけデコードしてLRUで上限枚数まで持つ
+# 元ファイルは最初に一度だけ読んでバイト列で持ち、ファイル自体は開いたままにしない
+# GIF・APNGの差分フレームはPILが頭から順にseekして前フレームの破棄方法を反映するため
+# 直前に読んだ位置を覚えておき、順番に読む限りは1フレーム分の処理で済ませる
+# フレームは256色に収まればパレット画像、それ以外はRGBAで持つ
+class LazyFrames(FrameSequence):
+    def __init__(self, path_image, limit=const.LIMIT_CACHE_FRAMES):
+        self.path_image = path_image
+        self.limit = limit
+        self.bytes_source = pathlib.Path(path_image).read_bytes()
+        self.im_source = Image.open(io.BytesIO(self.bytes_source))
+        self.number_frames = getattr(self.im_source, "n_frames", 1)
+        self.size = self.im_source.size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_frame(self, ix):
+        with self.lock:
+            frame = self.entries.get(ix)
+            if frame is None:
+                # APNGはPILが戻る方向のseekに対応していないため、戻る時は開き直して先頭から読み進める
+                if ix < self.im_source.tell():
+                    self.im_source.close()
+                    self.im_source = Image.open(io.BytesIO(self.bytes_source))
+
+                self.im_source.seek(ix)
+                frame = self.entries[ix] = editor.convert_frame(self.im_source)
+                while len(self.entries) > self.limit:
+                    self.entries.popitem(last=False)
+
+            self.entries.move_to_end(ix)
+
+        return frame
+
+    # 削除や置換で使わなくなったフレームを手放す
+    def close(self):
+        with self.lock:
+            self.entries.clear()
+            self.im_source.close()
+
+
+# プロパティ変更のまとめ役 入れ子になったtransactionを全て抜けた時に
+# 変更されたパーツのidをまとめて1回だけlistenersへ通知する
+# 変更はUIのスレッドだけが行い、描画のスレッドとはlockで排他にする
+# count_waitingはlockを待っている変更の数 描画は待っている変更があればパーツの合間で打ち切る
+class TransactionState:
+    def __init__(self):
+        self.depth = 0
+        self.ids_changed = set()
+        self.listeners = []
+        self.lock = threading.RLock()
+        self.count_waiting = 0
+        self.condition_waiting = threading.Condition()
+
+    def begin(self):
+        with self.condition_waiting:
+            self.count_waiting += 1
+
+        self.lock.acquire()
+        with self.condition_waiting:
+            self.count_waiting -= 1
+            self.condition_waiting.notify_all()
+
+        self.depth += 1
+
+    def record(self, lst_parts):
+        self.ids_changed.update(parts.id_parts for parts in lst_parts)
+        return lst_parts
+
+    def record_file(self, file):
+        self.ids_changed.add(file.id_file)
+        return file
+
+    # 描画のスレッドから呼ぶ 待っている変更を全て先に通してからlockを取る
+    @contextmanager
+    def reading(self):
+        with self.condition_waiting:
+            self.condition_waiting.wait_for(lambda: self.count_waiting == 0)
+
+        with self.lock:
+            yield self
+
+    def end(self):
+        try:
+            self.depth -= 1
+            if self.depth or not self.ids_changed:
+                return
+
+            ids_changed = frozenset(self.ids_changed)
+            self.ids_changed = set()
+            for listener in list(self.listeners):
+                listener(ids_changed)
+        finally:
+            self.lock.release()
+
+
+# ImageManagerの変更をまとめてtransactionの中で行う 描画のスレッドとの排他もこれで行われる
+def in_transaction(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# 画素のある範囲だけを切り出したレイヤー originはキャンバス上での左上座標
+@dataclass
+class SparseLayer:
+    image: Image.Image
+    origin: tuple[int, int] = (0, 0)
+
+    @property
+    def bbox(self):
+        left, top = self.origin
+        return left, top, left + self.image.width, top + self.image.height
+
+    # キャンバス座標でbboxを切り出す 範囲外は透明
+    def crop(self, bbox):
+        left, top = self.origin
+        box_left, box_top, box_right, box_bottom = bbox
+        return self.image.crop((box_left - left, box_top - top, box_right - left, box_bottom - top))
+
+    def translate(self, dx, dy):
+        left, top = self.origin
+        return SparseLayer(self.image, (left + dx, top + dy))
+
+    def collide(self, pos):
+        left, top = self.origin
+        x, y = pos
+        return editor.collide_point(self.image, (x - left, y - top))
+
+
+# フレーム内のクリッパー依存関係 クリッパー→クリップされるパーツの向きで辺を張る
+class ClipperGraph:
+    def __init__(self):
+        self.structure = None
+        self.order_eval = []
+        self.nodes_cycle = set()
+        self.dic_downstream = {}
+        self.dic_memo = {}
+
+    def update(self, order_parts):
+        structure = tuple((parts.id_parts, tuple(parts.clippers_id)) for parts in order_parts)
+        if structure == self.structure:
+            return
+
+        self.structure = structure
+        self.dic_memo = {}
+        lst_id = [id_parts for id_parts, clippers_id in structure]
+        dic_clippers = {id_parts: [id_clipper for id_clipper in clippers_id if id_clipper in lst_id]
+                        for id_parts, clippers_id in structure}
+        dic_targets = {id_parts: [] for id_parts in lst_id}
+        for id_parts, clippers_id in dic_clippers.items():
+            for id_clipper in clippers_id:
+                dic_targets[id_clipper].append(id_parts)
+
+        # トポロジカルソート 並べられずに残ったノードは循環に含まれる(か循環の下流にある)
+        dic_degree = {id_parts: len(clippers_id) for id_parts, clippers_id in dic_clippers.items()}
+        queue = [id_parts for id_parts in lst_id if dic_degree[id_parts] == 0]
+        order_eval = []
+        while queue:
+            id_parts = queue.pop(0)
+            order_eval.append(id_parts)
+            for id_target in dic_targets[id_parts]:
+                dic_degree[id_target] -= 1
+                if dic_degree[id_target] == 0:
+                    queue.append(id_target)
+
+        self.nodes_cycle = set(lst_id) - set(order_eval)
+        self.order_eval = order_eval + [id_parts for id_parts in lst_id
+                                        if id_parts in self.nodes_cycle]
+        self.dic_downstream = {id_parts: self.collect_downstream(id_parts, dic_targets)
+                               for id_parts in lst_id}
+
+    @staticmethod
+    def collect_downstream(id_parts, dic_targets):
+        downstream = set()
+        stack = list(dic_targets[id_parts])
+        while stack:
+            id_target = stack.pop()
+            if id_target in downstream:
+                continue
+
+            downstream.add(id_target)
+            stack.extend(dic_targets[id_target])
+
+        return downstream
+
+    def has_cycle(self):
+        return bool(self.nodes_cycle)
+
+    # 依存順にクリップ済みレイヤーを評価する
+    # 前回から元レイヤーが変わったパーツとその下流だけを評価し直し、それ以外はメモを使う
+    # 循環しているノードは未評価のクリッパーを元レイヤーのまま使う
+    def evaluate(self, dic_parts, dic_layer):
+        set_changed = set()
+        for id_parts in self.order_eval:
+            memo = self.dic_memo.get(id_parts)
+            if memo is None or memo[0] is not dic_layer.get(id_parts):
+                set_changed.add(id_parts)
+                set_changed.update(self.dic_downstream[id_parts])
+
+        dic_clipped = {}
+        for id_parts in self.order_eval:
+            if id_parts not in set_changed:
+                dic_clipped[id_parts] = self.dic_memo[id_parts][1]
+                continue
+
+            parts = dic_parts.get(id_parts)
+            layer = dic_layer.get(id_parts)
+            clippers = [dic_clipped.get(id_clipper, dic_layer.get(id_clipper))
+                        for id_clipper in parts.clippers_id if id_clipper in dic_layer]
+            dic_clipped[id_parts] = parts.clip_layer(layer, clippers)
+            self.dic_memo[id_parts] = (layer, dic_clipped[id_parts])
+
+        return dic_clipped
+
+
 @dataclass
 class PartsImage:
+    # エッジ検出とぼかしがレイヤーの外側に及ぶ範囲
+    MARGIN_EDGE = 4
+
     id_file: str
     id_parts: str
     type_image: const.ImageType
@@ -34,9 +486,20 @@ class PartsImage:
     alpha_blend: float = 0.3
     clippers_id: list = field(default_factory=list)
     image_edit: Image.Image = None
-    layer: Image.Image = None
+    layer: SparseLayer = None
+    cache_layer: LayerCache = None
+    # draftは操作中に低品質で変形するかどうか is_draft_editはimage_editが低品質で作られたかどうか
+    draft: bool = False
+    is_draft_edit: bool = False
 
     def __post_init__(self):
+        if self.cache_layer is None:
+            self.cache_layer = LayerCache()
+
+        # 旧形式のプロジェクトではキャンバスサイズのレイヤーが保存されているため合成時に作り直す
+        if not isinstance(self.layer, SparseLayer):
+            self.layer = None
+
         if self.offset_center is None:
             left, top, right, bottom = self.image.getbbox()
             width, height = self.image.size
@@ -45,46 +508,158 @@ class PartsImage:
             self.image = self.image.crop(self.image.getbbox())
 
         if not self.icon:
-            self.icon = editor.create_icon(self.image, const.ICON_SIZE, const.THUMB_SIZE,
-                                           const.BG_PARTS)
+            self.icon = STORE_ICON.create_icon(self.get_fingerprint(), self.image, const.ICON_SIZE,
+                                               const.THUMB_SIZE, const.BG_PARTS)
 
-        if not self.image_edit:
-            self.edit_image()
+    # image_editは合成やアイコンで必要になった時に作る 設定の変更ではmark_editで作り直しを予約する
+    def get_image_edit(self):
+        image_edit = self.image_edit
+        if image_edit is None:
+            image_edit = self.edit_image()
 
-    def edit_image(self):
-        image_edit = self.image.convert("RGBA")
-        image_edit = ImageOps.mirror(image_edit) if self.is_flip else image_edit
-        size_zoom = (int(image_edit.width * self.zoom_x),
-                     int(image_edit.height * self.zoom_y))
+        return image_edit
 
-        image_edit = image_edit.resize(size_zoom, Image.LANCZOS)
-        alpha = image_edit.split()[-1]
-        mask = Image.eval(alpha, lambda a: np.clip(a - self.transparency, 0, 255))
-        image_edit.putalpha(mask)
-        image_edit = image_edit.rotate(self.angle, resample=Image.BICUBIC, expand=True)
+    def mark_edit(self):
+        self.image_edit = None
 
-        if self.mode_blend != const.BlendMode.NONE:
-            image_edit = editor.blend_color(image_edit, self.color_blend,
-                                            self.mode_blend, self.alpha_blend)
+    # 変形→透過→カラーブレンドの段階ごとにキャッシュし、変わった段階以降だけを作り直す
+    def edit_image(self):
+        # 画質は結果と一緒に持つ 低品質の結果は操作が終わった後の要求にだけ使わない
+        key_geometry = (id(self.image), self.zoom_x, self.zoom_y, self.angle, self.is_flip)
+        entry_geometry = self.cache_layer.get("geometry", key_geometry)
+        if entry_geometry is None or (entry_geometry[1] and not self.draft):
+            # 他のパーツが同じ素材を同じように変形していればその結果を共有する 共有するのは高品質だけ
+            key_shared = (self.get_fingerprint(), *key_geometry[1:])
+            image_geometry = CACHE_TRANSFORM.get(key_shared)
+            is_draft_geometry = False
+            if image_geometry is None:
+                is_draft_geometry = self.draft and editor.is_interpolated(
+                    self.image.size, self.zoom_x, self.zoom_y, self.angle)
+                image_geometry = editor.transform_image(self.image, self.zoom_x, self.zoom_y,
+                                                        self.angle, self.is_flip, is_draft_geometry)
+                if not is_draft_geometry:
+                    CACHE_TRANSFORM.put(key_shared, image_geometry)
+
+            entry_geometry = self.cache_layer.put("geometry", key_geometry,
+                                                  (image_geometry, is_draft_geometry), (self.image,))
+
+        image_geometry, is_draft_geometry = entry_geometry
+
+        key_alpha = (id(image_geometry), self.transparency)
+        image_alpha = self.cache_layer.get("alpha", key_alpha)
+        if image_alpha is None:
+            image_alpha = (editor.apply_transparency(image_geometry, self.transparency)
+                           if self.transparency else image_geometry)
+            self.cache_layer.put("alpha", key_alpha, image_alpha, (image_geometry,))
+
+        key_color = (id(image_alpha), self.mode_blend, tuple(self.color_blend), self.alpha_blend)
+        image_edit = self.cache_layer.get("color", key_color)
+        if image_edit is None:
+            image_edit = image_alpha
+            if self.mode_blend != const.BlendMode.NONE:
+                image_edit = editor.blend_color(image_alpha, self.color_blend,
+                                                self.mode_blend, self.alpha_blend)
+
+            self.cache_layer.put("color", key_color, image_edit, (image_alpha,))
 
         self.image_edit = image_edit
+        self.is_draft_edit = is_draft_geometry
+        return image_edit
 
-    def create_layer(self, size_layer, offset_base):
-        campus_layer = Image.new("RGBA", size_layer, (255, 255, 255, 0))
+    def get_fingerprint(self):
+        key = id(self.image)
+        fingerprint = self.cache_layer.get("fingerprint", key)
+        if fingerprint is None:
+            fingerprint = self.cache_layer.put("fingerprint", key,
+                                               editor.get_fingerprint(self.image), (self.image,))
+
+        return fingerprint
+
+    # 操作が終わったら低品質で作った画像だけを作り直す
+    def finish_draft(self):
+        self.draft = False
+        if self.is_draft_edit:
+            self.mark_edit()
+
+    def get_offset_layer(self, size_layer, offset_base, size_edit):
         offset = np.array(size_layer) // 2 - np.array(
-            self.image_edit.size) // 2 + self.offset + self.offset_center
+            size_edit) // 2 + self.offset + self.offset_center
         if self.type_image not in const.TYPES_BASE:
             offset = offset + offset_base
 
-        campus_layer.paste(self.image_edit, tuple(offset))
-        return campus_layer
+        return offset
 
-    def edit_layer(self, layer, clippers, color_selection):
-        layer = editor.clip_by_images(layer, clippers)
-        if color_selection:
-            layer = editor.draw_selection_marker(layer, color_selection)
+    # レイヤー上で画素が存在しうる範囲
+    def get_bbox_layer(self, size_layer, offset_base, size_edit):
+        left, top = self.get_offset_layer(size_layer, offset_base, size_edit)
+        width, height = size_edit
+        width_layer, height_layer = size_layer
+        bbox = (int(np.clip(left, 0, width_layer)), int(np.clip(top, 0, height_layer)),
+                int(np.clip(left + width, 0, width_layer)), int(np.clip(top + height, 0, height_layer)))
+        return bbox
 
-        self.layer = layer
+    def create_layer(self, size_layer, offset_base):
+        image_edit = self.get_image_edit()
+        offset = self.get_offset_layer(size_layer, offset_base, image_edit.size)
+        # 画像・位置・キャンバスサイズが変わっていなければ前回のレイヤーを使い回す
+        key = (id(image_edit), tuple(offset), tuple(size_layer))
+        layer = self.cache_layer.get("layer", key)
+        if layer is not None:
+            return layer
+
+        # キャンバスからはみ出す部分だけを切り落とし、収まっていればimage_editをそのまま使う
+        left, top = offset
+        bbox = self.get_bbox_layer(size_layer, offset_base, image_edit.size)
+        box_left, box_top, box_right, box_bottom = bbox
+        image_layer = (image_edit if bbox == (left, top, left + image_edit.width,
+                                              top + image_edit.height) else
+                       image_edit.crop((box_left - left, box_top - top,
+                                        box_right - left, box_bottom - top)))
+
+        layer = SparseLayer(image_layer, (box_left, box_top))
+        return self.cache_layer.put("layer", key, layer, (image_edit,))
+
+    def clip_layer(self, layer, clippers):
+        if not clippers:
+            return layer
+
+        key = (id(layer), tuple(id(clipper) for clipper in clippers))
+        layer_clip = self.cache_layer.get("clip", key)
+        if layer_clip is None:
+            # クリッパーはこのレイヤーの範囲だけを切り出して使う
+            image_clip = editor.clip_by_images(layer.image,
+                                               [clipper.crop(layer.bbox) for clipper in clippers])
+            layer_clip = SparseLayer(image_clip, layer.origin)
+            self.cache_layer.put("clip", key, layer_clip, (layer, *clippers))
+
+        return layer_clip
+
+    # 選択マーカー用の輪郭の帯 レイヤーの範囲で作りレイヤーと一緒にキャッシュする
+    def get_mask_outline(self):
+        key = id(self.layer)
+        mask = self.cache_layer.get("outline", key)
+        if mask is not None:
+            return mask
+
+        # キャンバス外に出て画素が無い場合はマーカーを描かない
+        image_mask = (editor.get_mask_outline(self.layer.image) if all(self.layer.image.size)
+                      else Image.new("L", (0, 0)))
+        mask = SparseLayer(image_mask, self.layer.origin)
+        return self.cache_layer.put("outline", key, mask, (self.layer,))
+
+    # レイヤーのエッジマスク ぼかしが及ぶ分だけ広げた範囲で作りレイヤーと一緒にキャッシュする
+    def get_mask_edge(self, size_layer):
+        key = (id(self.layer), tuple(size_layer))
+        mask = self.cache_layer.get("mask", key)
+        if mask is not None:
+            return mask
+
+        bbox_edge = editor.pad_bbox(self.layer.bbox, self.MARGIN_EDGE, size_layer)
+        left, top, right, bottom = bbox_edge
+        image_mask = (editor.get_mask_edge(self.layer.crop(bbox_edge))
+                      if left < right and top < bottom else Image.new("L", (0, 0)))
+        mask = SparseLayer(image_mask, (left, top))
+        return self.cache_layer.put("mask", key, mask, (self.layer,))
 
     def overwrite_property(self, parts_replace, clippers_id=None):
         self.offset = parts_replace.offset
@@ -99,7 +674,7 @@ class PartsImage:
         self.color_blend = parts_replace.color_blend
         self.alpha_blend = parts_replace.alpha_blend
         self.clippers_id = parts_replace.clippers_id if clippers_id is None else clippers_id
-        self.edit_image()
+        self.mark_edit()
 
     def set_offset(self, offset):
         self.offset = offset
@@ -113,33 +688,33 @@ class PartsImage:
 
     def set_angle(self, angle):
         self.angle = angle
-        self.edit_image()
+        self.mark_edit()
 
     def add_angle(self, angle_delta):
         self.angle = np.clip(self.angle + angle_delta, -360, 360)
-        self.edit_image()
+        self.mark_edit()
 
     def set_zoom(self, zoom_x, zoom_y):
         self.zoom_x = zoom_x
         self.zoom_y = zoom_y
-        self.edit_image()
+        self.mark_edit()
 
     def set_transparency(self, transparency):
         self.transparency = transparency
-        self.edit_image()
+        self.mark_edit()
 
     def set_alias(self, anti_alias):
         self.anti_alias = anti_alias
 
     def set_flip(self, is_flip):
         self.is_flip = is_flip
-        self.edit_image()
+        self.mark_edit()
 
     def set_blend_color(self, mode_blend, color_blend, alpha_blend):
         self.mode_blend = mode_blend
         self.color_blend = color_blend
         self.alpha_blend = alpha_blend
-        self.edit_image()
+        self.mark_edit()
 
     def add_clipper(self, id_parts):
         if id_parts not in self.clippers_id:
@@ -156,18 +731,29 @@ class PartsImage:
 
     def collide(self, pos):
         x, y = pos
-        width, height = self.image_edit.size
+        image_edit = self.get_image_edit()
+        width, height = image_edit.size
         if not (0 <= x < width and 0 <= y < height):
             return False
 
-        alpha = self.image_edit.split()[-1]
+        alpha = image_edit.split()[-1]
         alpha_pixel = alpha.getpixel((x, y))
 
         return bool(alpha_pixel)
 
     def get_bmp_icon(self):
-        bmp = wx.Bitmap.FromBufferRGBA(*self.icon.size, self.icon.tobytes())
-        return bmp
+        return STORE_ICON.get_bitmap(self.icon)
+
+    def get_ix_icon(self):
+        return STORE_ICON.get_ix(self.icon)
+
+    # 保存用にキャッシュを除いた複製 常に高品質で合成するため操作中の低品質な画像は渡さない
+    # image_editが無ければ元画像を渡して変形は複製の側で行う
+    def create_snapshot(self):
+        image_edit = None if self.is_draft_edit else self.image_edit
+        return replace(self, image=self.image if image_edit is None else None,
+                       image_edit=image_edit, layer=None, cache_layer=None, draft=False,
+                       is_draft_edit=False, clippers_id=self.clippers_id.copy())
 
 
 @dataclass
@@ -182,6 +768,8 @@ class FileImage:
     type_image: const.ImageType = None
     size: np.ndarray = None
     number_frames: int = None
+    # フレームを切り詰めた範囲の元のキャンバス上の左上 sizeは元のキャンバスのまま
+    origin_trim: np.ndarray = None
 
     offset: np.ndarray = np.array([0, 0])
     angle: int = 0
@@ -198,9 +786,26 @@ class FileImage:
 
     def __post_init__(self):
         exists_frames = bool(self.frames)
+        box_trim = None
+        # 透明な余白を落とすため全フレームの画素がある範囲の和に切り詰める
+        # ファイルから読む場合は範囲を調べるだけで全フレームのデコードが要るため切り詰めず、
+        # 先頭のフレームだけをデコードして残りは必要になった時に読む
+        if self.origin_trim is None:
+            if exists_frames:
+                size_source, box_trim = editor.get_box_trim(self.frames)
+                if self.size is None:
+                    self.size = np.array(size_source)
+
+            self.origin_trim = np.array(box_trim[:2] if box_trim else (0, 0))
+
         if not exists_frames:
-            im = Image.open(self.path_image)
-            self.frames = [frame.convert("RGBA") for frame in ImageSequence.Iterator(im)]
+            self.frames = LazyFrames(self.path_image)
+        elif isinstance(self.frames, list):
+            frames_stack = create_frame_stack(self.frames, box_trim)
+            if frames_stack is None and box_trim:
+                frames_stack = [frame.crop(box_trim) for frame in self.frames]
+
+            self.frames = frames_stack or self.frames
 
         if not self.icon:
             self.icon = editor.create_icon(self.frames[0], const.ICON_SIZE, const.THUMB_MINI_SIZE,
@@ -219,6 +824,16 @@ class FileImage:
         if self.number_frames is None:
             self.number_frames = len(self.frames)
 
+    # 切り詰めたフレームから作ったパーツを元のキャンバス上の位置に戻すずれ
+    def get_offset_trim(self):
+        size_trim = np.array(self.frames[0].size)
+        return self.origin_trim + size_trim // 2 - np.array(self.size) // 2
+
+    # 削除や置換で使わなくなった元ファイルを手放す
+    def close(self):
+        if isinstance(self.frames, LazyFrames):
+            self.frames.close()
+
     def get_type(self, path_image, frames):
         in_material = const.FOLDER_MATERIAL in path_image.parents
         in_append = const.FOLDER_APPEND in path_image.parents
@@ -305,13 +920,16 @@ class FileImage:
         self.alpha_blend = file_replace.alpha_blend
         self.clippers_id = file_replace.clippers_id.copy()
 
-    # self.iconに直接bmpを与えたかったけどbmpはpickle化出来なかったので都度変換する。
+    # self.iconに直接bmpを与えたかったけどbmpはpickle化出来なかったので変換結果はSTORE_ICONに置く
     def get_bmp_icon(self):
-        bmp = wx.Bitmap.FromBufferRGBA(*self.icon.size, self.icon.tobytes())
-        return bmp
+        return STORE_ICON.get_bitmap(self.icon)
+
+    def get_ix_icon(self):
+        return STORE_ICON.get_ix(self.icon)
 
     def __iter__(self):
-        self.cycle_image = cycle(self.frames)
+        # cycleは一巡したフレームを全て抱え込むため番号で回す
+        self.cycle_image = map(self.frames.__getitem__, cycle(range(len(self.frames))))
         return self
 
     def __next__(self):
@@ -320,8 +938,20 @@ class FileImage:
 
 @dataclass
 class FrameImage:
+    # ぼかし・エッジ検出の影響が及ぶ範囲
+    MARGIN_DIRTY = 8
+
     order_parts: list = field(default_factory=list)
     iter_frame: list = field(default_factory=list)
+    cache_composite: LayerCache = None
+    graph_clipper: ClipperGraph = None
+
+    def __post_init__(self):
+        if self.cache_composite is None:
+            self.cache_composite = LayerCache()
+
+        if self.graph_clipper is None:
+            self.graph_clipper = ClipperGraph()
 
     def append(self, parts_append, id_file_replace=None):
         if not id_file_replace:
@@ -368,61 +998,334 @@ class FrameImage:
         parts_insert = self.order_parts.pop(ix_from)
         self.order_parts.insert(ix_to, parts_insert)
 
-    def composite_image(self, size, offset_base, selections=None, selected_file=False):
-        color_marker = (0, 255, 0) if selected_file else (0, 0, 255)
-        if selections is None:
-            selections = []
-
+    # anti_alias=Falseの時はアンチエイリアスを省いた下書きとして合成する
+    # cancelが真を返すとパーツの合間でRenderCancelledを送出して中断する
+    def composite_image(self, size, offset_base, anti_alias=True, cancel=None):
         order_parts = self.order_parts.copy()
         if not any([parts.visible for parts in order_parts]):
             image_empty = Image.new("RGBA", size, (255, 255, 255, 0))
             return image_empty
 
-        # レイヤーの作成
-        dic_layer = {parts.id_parts: parts.create_layer(size, offset_base)
-                     for parts in order_parts}
+        size = tuple(size)
+        dic_layer, dic_mask = self.prepare_layers(order_parts, size, offset_base, anti_alias,
+                                                  cancel)
+
+        # 前回の合成結果から変化したパーツの範囲だけを合成し直す
+        dic_state = self.get_dic_state(order_parts)
+        key = (size, tuple(dic_state.keys()))
+        name_cache = "frame" if anti_alias else "frame_draft"
+        cache = self.cache_composite.get(name_cache, key)
+        if cache is None:
+            campus_frame = self.blend_layers(order_parts, dic_layer, dic_mask, size, anti_alias,
+                                             cancel)
+            pick = self.pick_layers(order_parts, dic_layer, (0, 0, *size))
+        else:
+            frame_prev, dic_state_prev, pick_prev = cache
+            bbox_dirty = self.get_bbox_dirty(dic_state, dic_state_prev, size)
+            campus_frame = frame_prev.copy()
+            pick = pick_prev.copy()
+            if bbox_dirty:
+                left, top, right, bottom = bbox_dirty
+                box_context = editor.pad_bbox(bbox_dirty, self.MARGIN_DIRTY, size)
+                left_ctx, top_ctx, right_ctx, bottom_ctx = box_context
+                size_context = (right_ctx - left_ctx, bottom_ctx - top_ctx)
+                dic_layer_crop = {id_parts: layer.translate(-left_ctx, -top_ctx)
+                                  for id_parts, layer in dic_layer.items()}
+                dic_mask_crop = {id_parts: mask.translate(-left_ctx, -top_ctx)
+                                 for id_parts, mask in dic_mask.items()}
+                campus_region = self.blend_layers(order_parts, dic_layer_crop, dic_mask_crop,
+                                                  size_context, anti_alias, cancel)
+                campus_region = campus_region.crop((left - left_ctx, top - top_ctx,
+                                                    right - left_ctx, bottom - top_ctx))
+                campus_frame.paste(campus_region, (left, top))
+                pick[top:bottom, left:right] = self.pick_layers(order_parts, dic_layer, bbox_dirty)
+
+        self.cache_composite.put(name_cache, key, (campus_frame, dic_state, pick))
+        self.store_pick(order_parts, pick)
+        # キャッシュした合成結果を保存処理などで書き換えられないよう複製して返す
+        return campus_frame.copy()
+
+    def prepare_layers(self, order_parts, size, offset_base, anti_alias=True, cancel=None):
+        # レイヤーの作成 クリップはクリッパーの依存順に評価する
+        dic_layer = {}
         for parts in order_parts:
-            clippers = [dic_layer.get(id_clipper) for id_clipper in parts.clippers_id]
-            color_selection = color_marker if parts.id_file in selections else None
-            parts.edit_layer(dic_layer.get(parts.id_parts), clippers, color_selection)
-            dic_layer[parts.id_parts] = parts.layer
+            check_cancel(cancel)
+            dic_layer[parts.id_parts] = parts.create_layer(size, offset_base)
 
+        self.graph_clipper.update(order_parts)
+        dic_parts = {parts.id_parts: parts for parts in order_parts}
+        dic_layer = self.graph_clipper.evaluate(dic_parts, dic_layer)
+        for parts in order_parts:
+            parts.layer = dic_layer.get(parts.id_parts)
+
+        # エッジマスクはパーツごとにキャッシュしたものを使う
+        check_cancel(cancel)
+        dic_mask = {parts.id_parts: parts.get_mask_edge(size)
+                    for parts in order_parts if parts.anti_alias and anti_alias}
+        return dic_layer, dic_mask
+
+    # 選択中のファイルより下と上のパーツを平坦化した下地と上地をキャッシュし、
+    # 選択中のパーツだけをその間に合成する ドラッグ中など対話的な更新で使う
+    # 下地と上地のアンチエイリアスは選択中のパーツを含めないぼかしで掛かるため
+    # 選択範囲の縁でcomposite_imageの結果とわずかに異なることがある(anti_alias=Falseなら一致する)
+    def composite_interactive(self, size, offset_base, selections, anti_alias=True, cancel=None):
+        order_parts = self.order_parts.copy()
+        lst_ix = [ix for ix, parts in enumerate(order_parts) if parts.id_file in selections]
+        if not lst_ix or not any([parts.visible for parts in order_parts]):
+            return self.composite_image(size, offset_base, anti_alias, cancel)
+
+        ix_under, ix_over = lst_ix[0], lst_ix[-1] + 1
+        parts_under, parts_over = order_parts[:ix_under], order_parts[ix_over:]
+        parts_middle = order_parts[ix_under:ix_over]
+
+        # 選択中のパーツをクリッパーにしている下地や上地のパーツがあれば平坦化できない
+        self.graph_clipper.update(order_parts)
+        ids_middle = {parts.id_parts for parts in parts_middle}
+        ids_downstream = set()
+        for id_parts in ids_middle:
+            ids_downstream |= self.graph_clipper.dic_downstream.get(id_parts, set())
+
+        if ids_downstream - ids_middle:
+            return self.composite_image(size, offset_base, anti_alias, cancel)
+
+        size = tuple(size)
+        dic_layer, dic_mask = self.prepare_layers(order_parts, size, offset_base, anti_alias,
+                                                  cancel)
+
+        # 選択中以外のパーツが変化したら下地と上地を作り直す
+        key = (size, ix_under, ix_over, tuple(parts.id_parts for parts in order_parts),
+               tuple(self.get_state_parts(parts) for parts in parts_under + parts_over))
+        name_cache = "plates" if anti_alias else "plates_draft"
+        plates = self.cache_composite.get(name_cache, key)
+        if plates is None:
+            plate_under = self.blend_layers(parts_under, dic_layer, dic_mask, size, anti_alias,
+                                            cancel)
+            plate_over = self.blend_layers(parts_over, dic_layer, dic_mask, size, anti_alias, cancel)
+            plate_flat = Image.alpha_composite(plate_under, plate_over)
+            pick_flat = self.pick_layers(order_parts, dic_layer, (0, 0, *size), ids_middle)
+            plates = self.cache_composite.put(name_cache, key,
+                                              (plate_under, plate_over, plate_flat, pick_flat))
+
+        plate_under, plate_over, plate_flat, pick_flat = plates
+        campus_frame = plate_flat.copy()
+        lst_bbox = [dic_layer.get(parts.id_parts).bbox for parts in parts_middle
+                    if parts.visible]
+        lst_bbox = [bbox for bbox in lst_bbox if bbox[0] < bbox[2] and bbox[1] < bbox[3]]
+        if not lst_bbox:
+            self.store_pick(order_parts, pick_flat)
+            return campus_frame
+
+        bbox_union = (min([bbox[0] for bbox in lst_bbox]), min([bbox[1] for bbox in lst_bbox]),
+                      max([bbox[2] for bbox in lst_bbox]), max([bbox[3] for bbox in lst_bbox]))
+        bbox_middle = editor.pad_bbox(bbox_union, self.MARGIN_DIRTY, size)
+        left, top, right, bottom = bbox_middle
+        box_context = editor.pad_bbox(bbox_middle, self.MARGIN_DIRTY, size)
+        left_ctx, top_ctx, right_ctx, bottom_ctx = box_context
+        size_context = (right_ctx - left_ctx, bottom_ctx - top_ctx)
+        dic_layer_crop = {id_parts: layer.translate(-left_ctx, -top_ctx)
+                          for id_parts, layer in dic_layer.items()}
+        dic_mask_crop = {id_parts: mask.translate(-left_ctx, -top_ctx)
+                         for id_parts, mask in dic_mask.items()}
+        campus_middle = self.blend_layers(parts_middle, dic_layer_crop, dic_mask_crop, size_context,
+                                          anti_alias, cancel)
+        campus_middle = campus_middle.crop((left - left_ctx, top - top_ctx,
+                                            right - left_ctx, bottom - top_ctx))
+        campus_region = Image.alpha_composite(plate_under.crop(bbox_middle), campus_middle)
+        campus_region = Image.alpha_composite(campus_region, plate_over.crop(bbox_middle))
+        campus_frame.paste(campus_region, (left, top))
+        pick = pick_flat.copy()
+        pick[top:bottom, left:right] = self.pick_layers(order_parts, dic_layer, bbox_middle)
+        self.store_pick(order_parts, pick)
+        return campus_frame
+
+    def blend_layers(self, order_parts, dic_layer, dic_mask, size, anti_alias=True, cancel=None):
+        if const.ENGINE_COMPOSITE == const.CompositeEngine.PIL:
+            return self.blend_layers_pil(order_parts, dic_layer, size, anti_alias, cancel)
+
+        # 合成 乗算済みアルファのキャンバスに各レイヤーのbbox内だけを直接重ねる
+        campus = editor.create_campus_premultiplied(size)
+        for parts in order_parts:
+            check_cancel(cancel)
+            if not parts.visible:
+                continue
+
+            layer = dic_layer.get(parts.id_parts)
+            editor.composite_premultiplied(campus, layer, editor.pad_bbox(layer.bbox, 0, size))
+
+        if not anti_alias:
+            return editor.convert_premultiplied(campus)
+
+        # アンチエイリアス ぼかしたフレームは全パーツで共有する
+        campus_frame = editor.convert_premultiplied(campus)
+        alpha_campus = campus_frame.split()[-1]
+        campus_smooth = campus_frame.filter(ImageFilter.GaussianBlur(0.75))
+        for parts in order_parts:
+            check_cancel(cancel)
+            if not parts.visible:
+                continue
+
+            layer = dic_layer.get(parts.id_parts)
+            if parts.anti_alias:
+                self.composite_anti_alias(campus, campus_smooth, dic_mask.get(parts.id_parts), size)
+
+            editor.composite_premultiplied(campus, layer, editor.pad_bbox(layer.bbox, 0, size))
+            # クリッパーで切り取った部分にもアンチエイリアスを掛ける
+            # 下地や上地のパーツがクリッパーの場合もあるためエッジマスクの有無で判定する
+            for id_clipper in parts.clippers_id:
+                mask_clipper = dic_mask.get(id_clipper)
+                if mask_clipper:
+                    self.composite_anti_alias(campus, campus_smooth, mask_clipper, size, layer)
+
+        return editor.convert_premultiplied(campus, alpha_campus)
+
+    # layer_outerを与えた場合はその画素がある範囲にだけエッジマスクを掛ける
+    @staticmethod
+    def composite_anti_alias(campus, campus_smooth, mask, size, layer_outer=None):
+        bbox = mask.bbox
+        if layer_outer:
+            bbox_outer = layer_outer.bbox
+            bbox = (max(bbox[0], bbox_outer[0]), max(bbox[1], bbox_outer[1]),
+                    min(bbox[2], bbox_outer[2]), min(bbox[3], bbox_outer[3]))
+
+        bbox = editor.pad_bbox(bbox, 0, size)
+        left, top, right, bottom = bbox
+        if left >= right or top >= bottom:
+            return
+
+        mask_edge = mask.crop(bbox)
+        if layer_outer:
+            mask_edge = ImageChops.darker(mask_edge, layer_outer.crop(bbox).split()[-1])
+
+        bbox_local = (0, 0, right - left, bottom - top)
+        editor.composite_premultiplied(campus[top:bottom, left:right],
+                                       campus_smooth.crop(bbox), bbox_local, mask_edge)
+
+    def blend_layers_pil(self, order_parts, dic_layer, size, anti_alias=True, cancel=None):
+        dic_layer = {id_parts: layer.crop((0, 0, *size)) for id_parts, layer in dic_layer.items()}
         # 合成
         campus_frame = Image.new("RGBA", size, (255, 255, 255, 0))
         for parts in order_parts:
+            check_cancel(cancel)
             if not parts.visible:
                 continue
 
-            campus_frame = Image.alpha_composite(campus_frame, parts.layer)
+            campus_frame = Image.alpha_composite(campus_frame, dic_layer.get(parts.id_parts))
+
+        if not anti_alias:
+            return campus_frame
 
         # アンチエイリアス
         alpha_campus = campus_frame.split()[-1]
         campus_smooth = campus_frame.filter(ImageFilter.GaussianBlur(0.75))
         for parts in order_parts:
+            check_cancel(cancel)
             if not parts.visible:
                 continue
 
+            layer = dic_layer.get(parts.id_parts)
             if parts.anti_alias:
-                campus_frame = editor.apply_anti_alias(campus_frame, campus_smooth, parts.layer)
+                campus_frame = editor.apply_anti_alias(campus_frame, campus_smooth, layer)
 
-            campus_frame = Image.alpha_composite(campus_frame, parts.layer)
+            campus_frame = Image.alpha_composite(campus_frame, layer)
             # クリッパーで切り取った部分にもアンチエイリアスを掛ける
             clippers = [parts_clipper for parts_clipper in order_parts if
                         parts_clipper.id_parts in parts.clippers_id]
             for parts_clipper in clippers:
                 if parts_clipper.anti_alias:
                     campus_frame = editor.apply_anti_alias(campus_frame, campus_smooth,
-                                                           parts_clipper.layer, parts.layer)
+                                                           dic_layer.get(parts_clipper.id_parts),
+                                                           layer)
 
         campus_frame.putalpha(alpha_campus)
         return campus_frame
 
+    @staticmethod
+    def get_state_parts(parts):
+        return id(parts.layer), parts.visible, parts.anti_alias, tuple(parts.clippers_id)
+
+    def get_dic_state(self, order_parts):
+        return {parts.id_parts: (self.get_state_parts(parts), parts.layer.bbox)
+                for parts in order_parts}
+
+    # ピックバッファ bbox内の各画素で最前面に見えているパーツの番号 何もなければ-1
+    @staticmethod
+    def pick_layers(order_parts, dic_layer, bbox, ids_exclude=()):
+        left, top, right, bottom = bbox
+        pick = np.full((bottom - top, right - left), -1, dtype=np.int16)
+        for ix, parts in enumerate(order_parts):
+            if not parts.visible or parts.id_parts in ids_exclude:
+                continue
+
+            bbox_layer = dic_layer.get(parts.id_parts).bbox
+            box = (max(left, bbox_layer[0]), max(top, bbox_layer[1]),
+                   min(right, bbox_layer[2]), min(bottom, bbox_layer[3]))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+
+            alpha = np.asarray(dic_layer.get(parts.id_parts).crop(box).split()[-1])
+            pick_box = pick[box[1] - top:box[3] - top, box[0] - left:box[2] - left]
+            pick_box[alpha > 0] = ix
+
+        return pick
+
+    # 合成結果の上に選択中のパーツの輪郭を描く 合成し直さずにマーカーを切り替えられる
+    def draw_markers(self, im, selections, selected_file=False):
+        color_marker = (0, 255, 0) if selected_file else (0, 0, 255)
+        for parts in self.order_parts:
+            if not (parts.visible and parts.layer and parts.id_file in selections):
+                continue
+
+            mask = parts.get_mask_outline()
+            bbox = editor.pad_bbox(mask.bbox, 0, im.size)
+            left, top, right, bottom = bbox
+            if left >= right or top >= bottom:
+                continue
+
+            im.paste(color_marker, bbox, mask.crop(bbox))
+
+        return im
+
+    # 合成時のレイヤー状態と合わせて保持し、状態が変わっていなければ当たり判定に使う
+    def store_pick(self, order_parts, pick):
+        self.cache_composite.put("pick", tuple(self.get_dic_state(order_parts).items()), pick)
+
+    # 変化したパーツの新旧の範囲を合わせた領域 ぼかしとエッジ検出の影響範囲分を広げる
+    def get_bbox_dirty(self, dic_state, dic_state_prev, size):
+        lst_bbox = []
+        for id_parts, (state, bbox) in dic_state.items():
+            state_prev, bbox_prev = dic_state_prev.get(id_parts)
+            if state == state_prev:
+                continue
+
+            lst_bbox.extend([bbox, bbox_prev])
+
+        lst_bbox = [bbox for bbox in lst_bbox if bbox[0] < bbox[2] and bbox[1] < bbox[3]]
+        if not lst_bbox:
+            return None
+
+        bbox_union = (min([bbox[0] for bbox in lst_bbox]), min([bbox[1] for bbox in lst_bbox]),
+                      max([bbox[2] for bbox in lst_bbox]), max([bbox[3] for bbox in lst_bbox]))
+        return editor.pad_bbox(bbox_union, self.MARGIN_DIRTY, size)
+
     def get_collide_image(self, pos):
+        # 直前の合成のピックバッファが使えれば1画素引くだけで済む
+        order_parts = self.order_parts.copy()
+        if all([parts.layer for parts in order_parts]):
+            pick = self.cache_composite.get("pick", tuple(self.get_dic_state(order_parts).items()))
+            if pick is not None:
+                x, y = pos
+                height, width = pick.shape
+                if not (0 <= x < width and 0 <= y < height):
+                    return None
+
+                ix = pick[y, x]
+                return order_parts[ix] if ix >= 0 else None
+
         for parts in self.order_parts[::-1]:
             if not parts.visible:
                 continue
 
-            if editor.collide_point(parts.layer, pos):
+            if parts.layer and parts.layer.collide(pos):
                 return parts
 
         return None
@@ -430,6 +1333,9 @@ class FrameImage:
     def get_order_parts(self):
         return self.order_parts.copy()
 
+    def create_snapshot(self):
+        return FrameImage([parts.create_snapshot() for parts in self.order_parts])
+
     def get_order_parts_display(self):
         return self.order_parts[::-1].copy()
 
@@ -471,11 +1377,19 @@ class ImageManager:
     filter_image: const.ImageFilter = const.ImageFilter.NONE
     fixed_size: bool = False
     fixed_number_frames: bool = False
+    # interaction draft_interactiveがTrueなら操作中は低品質で描画する
+    draft_interactive: bool = True
+    interacting: bool = False
+    state_transaction: TransactionState = None
     # system
     offset_base: np.ndarray = const.OFFSET_FLAT
     id_file: int = 0
     id_parts: int = 0
 
+    def __post_init__(self):
+        if self.state_transaction is None:
+            self.state_transaction = TransactionState()
+
     # デバッグ用
     def show_data(self):
         print("order_file", len(self.order_file))
@@ -497,6 +1411,7 @@ class ImageManager:
         print("selections", self.ix_frame, self.selections, self.is_selected())
 
     # 画像の追加
+    @in_transaction
     def append(self, path_image, frames=None):
         file = self.create_file_image(path_image, frames)
         if not file:
@@ -526,6 +1441,7 @@ class ImageManager:
         self.adjust_system()
 
     # 画像の置換
+    @in_transaction
     def replace(self, path_image, id_replace, frames=None):
         replaced_file = self.is_file(id_replace)
         file_new = self.create_file_image(path_image, frames, replaced_file)
@@ -541,6 +1457,7 @@ class ImageManager:
 
     def replace_file(self, file_new, id_replace):
         file_old = self.dic_image.get(id_replace)
+        file_old.close()
         lst_id_old = self.get_lst_clippers_id(id_replace)
         file_new.overwrite_property(file_old)
 
@@ -574,10 +1491,11 @@ class ImageManager:
         parts_old = self.dic_image.get(id_replace)
         file_replace = self.order_file.get(parts_old.id_file)
         ix_replace = self.get_ix_frame_by_id_parts(id_replace)
-        im_parts = [im_parts for ix, im_parts in zip(range(ix_replace + 1), file_new)
-                    if ix == ix_replace][0]
+        # 置換するフレームだけをデコードする フレーム数が足りなければ繰り返した位置を使う
+        im_parts = file_new.frames[ix_replace % len(file_new.frames)]
         label = f"【F{ix_replace + 1}】{file_replace.label}"
-        parts_new = self.create_parts_image(file_replace, im_parts, label)
+        # im_partsは置換元のファイルの範囲で切り詰められているため、ずれも置換元から求める
+        parts_new = self.create_parts_image(file_replace, im_parts, label, file_new.get_offset_trim())
         parts_new.overwrite_property(parts_old)
         frame = self.order_frame[ix_replace]
         frame.replace_parts(parts_new, id_replace)
@@ -587,8 +1505,10 @@ class ImageManager:
         dic_update_parts = {parts_old.id_parts: parts_new.id_parts}
         self.update_clipper(None, dic_update_parts)
         self.select(ix_replace, parts_new.id_parts, False)
+        file_new.close()
 
     # 画像の削除
+    @in_transaction
     def remove(self, id_image):
         if self.is_file(id_image):
             self.remove_by_id_file(id_image)
@@ -599,6 +1519,7 @@ class ImageManager:
 
     def remove_by_id_file(self, id_file):
         lst_id_parts = [parts.id_parts for parts in self.dic_file_children.get(id_file) if parts]
+        self.order_file[id_file].close()
         del self.order_file[id_file]
         del self.dic_file_children[id_file]
         del self.dic_image[id_file]
@@ -633,11 +1554,16 @@ class ImageManager:
         self.update_clipper(None, dic_update_parts)
 
     # クリッパー
+    @in_transaction
     def add_clipper(self, id_target, id_clipper):
+        # 循環するクリップは合成結果が定まらないため受け付けない
+        if self.creates_clipper_cycle(id_target, id_clipper):
+            return False
+
         image = self.dic_image.get(id_target)
         image.add_clipper(id_clipper)
         if self.is_parts(id_target):
-            return
+            return True
 
         children_target = self.dic_file_children.get(id_target)
         children_clipper = self.dic_file_children.get(id_clipper)
@@ -645,6 +1571,38 @@ class ImageManager:
             if parts_target and parts_clipper:
                 parts_target.add_clipper(parts_clipper.id_parts)
 
+        return True
+
+    # id_clipperのクリッパーを辿ってid_targetに行き着くなら循環する
+    def creates_clipper_cycle(self, id_target, id_clipper):
+        # ファイル同士のクリップはフレームごとのパーツ同士にも張られるため、
+        # パーツに個別に付けたクリップと組み合わさって循環しないかも調べる
+        if self.is_file(id_target):
+            children_target = self.dic_file_children.get(id_target)
+            children_clipper = self.dic_file_children.get(id_clipper)
+            for parts_target, parts_clipper in zip(children_target, children_clipper):
+                if (parts_target and parts_clipper and
+                        self.creates_clipper_cycle(parts_target.id_parts, parts_clipper.id_parts)):
+                    return True
+
+        stack = [id_clipper]
+        visited = set()
+        while stack:
+            id_image = stack.pop()
+            if id_image == id_target:
+                return True
+
+            if id_image in visited:
+                continue
+
+            visited.add(id_image)
+            image = self.dic_image.get(id_image)
+            if image:
+                stack.extend(image.clippers_id)
+
+        return False
+
+    @in_transaction
     def remove_clipper(self, id_target, id_clipper):
         image = self.dic_image.get(id_target)
         image.remove_clipper(id_clipper)
@@ -668,8 +1626,10 @@ class ImageManager:
                     parts.update_clipper(dic_update_parts)
 
     # オールクリア　初期化
+    @in_transaction
     def clear(self):
-        # data
+        # data 読込済みのファイルは先に手放す
+        self.close()
         self.order_file = {}
         self.order_frame = [FrameImage()]
         self.dic_file_children = {}
@@ -691,17 +1651,20 @@ class ImageManager:
         self.fixed_size = False
         self.fixed_number_frames = False
 
-        # system
+        # system 操作中のまま消すと次の作業が低品質の描画で始まるため戻しておく
         self.offset_base = np.array([0, 0])
         self.id_file = 0
         self.id_parts = 0
+        self.interacting = False
 
     # フレーム・画像選択
+    @in_transaction
     def shift_ix_frame(self, ix_delta):
         self.ix_frame = (self.ix_frame + ix_delta) % self.number_frames
         if self.ix_frame < 0:
             self.ix_frame = self.number_frames - 1
 
+    @in_transaction
     def select(self, ix_frame, id_image, ctrl_down):
         if ix_frame is not None:
             self.ix_frame = ix_frame
@@ -719,6 +1682,7 @@ class ImageManager:
             else:
                 self.selections = [id_file]
 
+    @in_transaction
     def select_by_pos(self, pos, ctrl_down):
         frame = self.order_frame[self.ix_frame]
         parts = frame.get_collide_image(pos)
@@ -750,35 +1714,82 @@ class ImageManager:
         id_image = parts.id_file if self.selected_file else parts.id_parts
         return id_image
 
+    @in_transaction
     def switch_selected_file(self, selected):
         self.selected_file = selected
 
     def is_selected(self):
         return any(self.selections)
 
+    # 対話的な操作 ドラッグやホイール、スピンでの変更前に呼ぶ
+    @in_transaction
+    def begin_interaction(self):
+        self.interacting = True
+        if not self.draft_interactive:
+            return
+
+        for parts in self.get_selection_parts():
+            parts.draft = True
+
+    # 操作が終わっていればTrueを返す 低品質で作った画像は作り直す
+    @in_transaction
+    def end_interaction(self):
+        if not self.interacting:
+            return False
+
+        self.interacting = False
+        for frame in self.order_frame:
+            for parts in frame.order_parts:
+                parts.finish_draft()
+
+        return True
+
+    @in_transaction
+    def switch_draft_interactive(self, draft_interactive):
+        self.draft_interactive = draft_interactive
+        self.end_interaction()
+
     # データ取得
     def get_images_selection(self):
         return self.get_selection_file() if self.selected_file else self.get_selection_parts()
 
-    def get_preview(self):
+    # 操作中は選択中のファイル以外を平坦化した下地と上地を使い回して合成する
+    # 低品質描画ならアンチエイリアスとフィルターも省く
+    # bufferに前回の戻り値を渡すと市松模様との合成結果をそこへ書き込む
+    def get_preview(self, cancel=None, buffer=None):
+        state = self.state_transaction
+
+        # UIのスレッドが変更を待っていれば打ち切って先に通す
+        def cancel_render():
+            return state.count_waiting > 0 or (cancel is not None and cancel())
+
+        with state.reading():
+            return self.composite_preview(cancel_render, buffer)
+
+    def composite_preview(self, cancel, buffer):
         frame = self.order_frame[self.ix_frame]
         # frame = self.order_frame[self.ix_frame]
-        if self.marked_selection:
-            im_preview = frame.composite_image(self.size, self.offset_base,
-                                               self.selections, self.selected_file)
+        is_draft = self.interacting and self.draft_interactive
+        if self.interacting and self.selections:
+            im_preview = frame.composite_interactive(self.size, self.offset_base, self.selections,
+                                                     not is_draft, cancel)
         else:
-            im_preview = frame.composite_image(self.size, self.offset_base)
+            im_preview = frame.composite_image(self.size, self.offset_base, cancel=cancel)
 
-        if self.filter_image != const.ImageFilter.NONE:
+        check_cancel(cancel)
+
+        if self.filter_image != const.ImageFilter.NONE and not is_draft:
             im_preview = editor.filtering_image(
                 [im_preview], self.filter_image, self.number_frames, self.ix_frame)[0]
 
-        if self.filter_color != const.ColorFilter.NONE:
+        if self.filter_color != const.ColorFilter.NONE and not is_draft:
             im_preview = editor.filtering_color(
                 [im_preview], self.filter_color, self.number_frames, self.ix_frame)[0]
 
-        image_chess = editor.create_chess_board(self.size, self.selected_file)
-        im_preview = Image.alpha_composite(image_chess, im_preview)
+        if self.marked_selection:
+            im_preview = frame.draw_markers(im_preview, self.selections, self.selected_file)
+
+        im_preview = editor.composite_chess_board(im_preview, self.selected_file, buffer)
         return im_preview
 
     def get_selection_file(self):
@@ -837,9 +1848,23 @@ class ImageManager:
     def get_order_frame(self):
         return self.order_frame
 
+    # 構成・全体プロパティパネルの表示に関わる状態 同じなら作り直しは不要
+    def get_state_component(self):
+        state_file = tuple((file.id_file, file.label, file.visible) for file in self.order_file.values())
+        state_frame = tuple(tuple((parts.id_parts, parts.label, parts.visible) for parts in frame.order_parts)
+                            for frame in self.order_frame)
+        state_composite = (self.fixed_number_frames, self.number_frames, self.fixed_size,
+                           tuple(self.size), self.duration_single, tuple(self.durations_multi),
+                           self.filter_color, self.filter_image)
+        return self.selected_file, self.ix_frame, state_file, state_frame, state_composite
+
     def get_image(self, id_image):
         return self.dic_image.get(id_image)
 
+    # 読込中の全ての画像のアイコン
+    def get_icons(self):
+        return [image.icon for image in self.dic_image.values()]
+
     def is_file(self, id_image):
         return isinstance(self.get_image(id_image), FileImage)
 
@@ -849,109 +1874,149 @@ class ImageManager:
     def can_marking(self):
         return self.filter_color == const.ColorFilter.NONE and self.filter_image == const.ImageFilter.NONE
 
+    @in_transaction
     def switch_marking(self):
         if self.can_marking():
             self.marked_selection = not self.marked_selection
 
     # 画像プロパティ設定
+    # with内の設定変更はまとめて1回の変更通知になる
+    @contextmanager
+    def transaction(self):
+        self.state_transaction.begin()
+        try:
+            yield self.state_transaction
+        finally:
+            self.state_transaction.end()
+
+    def add_listener(self, listener):
+        if listener not in self.state_transaction.listeners:
+            self.state_transaction.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.state_transaction.listeners:
+            self.state_transaction.listeners.remove(listener)
+
+    def get_selection_parts_changed(self):
+        return self.state_transaction.record(self.get_selection_parts())
+
     def set_offset(self, offset):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_offset(offset)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_offset(offset)
 
-        for parts in self.get_selection_parts():
-            parts.set_offset(offset)
+            for parts in self.get_selection_parts_changed():
+                parts.set_offset(offset)
 
     def add_offset(self, offset):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.add_offset(offset, self.size)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.add_offset(offset, self.size)
 
-        for parts in self.get_selection_parts():
-            parts.add_offset(offset, self.size)
+            for parts in self.get_selection_parts_changed():
+                parts.add_offset(offset, self.size)
 
     def set_angle(self, angle):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_angle(angle)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_angle(angle)
 
-        for parts in self.get_selection_parts():
-            parts.set_angle(angle)
+            for parts in self.get_selection_parts_changed():
+                parts.set_angle(angle)
 
     def add_angle(self, angle):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.add_angle(angle)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.add_angle(angle)
 
-        for parts in self.get_selection_parts():
-            parts.add_angle(angle)
+            for parts in self.get_selection_parts_changed():
+                parts.add_angle(angle)
 
     def set_zoom(self, zoom_x, zoom_y):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_zoom(zoom_x, zoom_y)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_zoom(zoom_x, zoom_y)
 
-        for parts in self.get_selection_parts():
-            parts.set_zoom(zoom_x, zoom_y)
+            for parts in self.get_selection_parts_changed():
+                parts.set_zoom(zoom_x, zoom_y)
 
     def set_transparency(self, transparency):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_transparency(transparency)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_transparency(transparency)
 
-        for parts in self.get_selection_parts():
-            parts.set_transparency(transparency)
+            for parts in self.get_selection_parts_changed():
+                parts.set_transparency(transparency)
 
     def set_alias(self, anti_alias):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_alias(anti_alias)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_alias(anti_alias)
 
-        for parts in self.get_selection_parts():
-            parts.set_alias(anti_alias)
+            for parts in self.get_selection_parts_changed():
+                parts.set_alias(anti_alias)
 
     def set_flip(self, is_flip):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_flip(is_flip)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_flip(is_flip)
 
-        for parts in self.get_selection_parts():
-            parts.set_flip(is_flip)
+            for parts in self.get_selection_parts_changed():
+                parts.set_flip(is_flip)
 
     def set_blend_color(self, mode_blend, color_blend, alpha_blend):
-        if self.selected_file:
-            for file in self.get_selection_file():
-                file.set_blend_color(mode_blend, color_blend, alpha_blend)
+        with self.transaction():
+            if self.selected_file:
+                for file in self.get_selection_file():
+                    file.set_blend_color(mode_blend, color_blend, alpha_blend)
 
-        for parts in self.get_selection_parts():
-            parts.set_blend_color(mode_blend, color_blend, alpha_blend)
+            for parts in self.get_selection_parts_changed():
+                parts.set_blend_color(mode_blend, color_blend, alpha_blend)
 
     def set_file_visible(self, id_file, visible):
-        file = self.order_file.get(id_file)
-        file.visible = visible
-        for parts in self.dic_file_children.get(id_file):
-            if parts:
+        with self.transaction() as state:
+            file = state.record_file(self.order_file.get(id_file))
+            file.visible = visible
+            children = [parts for parts in self.dic_file_children.get(id_file) if parts]
+            for parts in state.record(children):
                 parts.visible = visible
 
     def set_parts_visible(self, id_parts, visible):
-        self.dic_image.get(id_parts).visible = visible
+        with self.transaction() as state:
+            parts = self.dic_image.get(id_parts)
+            state.record([parts])
+            parts.visible = visible
 
     def set_label(self, id_image, label):
-        image = self.get_image(id_image)
-        image.label = label
-        if isinstance(image, PartsImage):
-            return
-
-        for ix, parts in enumerate(self.dic_file_children.get(id_image)):
-            if parts:
-                parts.label = f"【F{ix + 1}】{label}"
+        with self.transaction() as state:
+            image = self.get_image(id_image)
+            image.label = label
+            if isinstance(image, PartsImage):
+                state.record([image])
+                return
+
+            state.record_file(image)
+            for ix, parts in enumerate(self.dic_file_children.get(id_image)):
+                if parts:
+                    state.record([parts])
+                    parts.label = f"【F{ix + 1}】{label}"
 
     # 合成プロパティ設定
+    @in_transaction
     def fix_num_frames(self, fixed):
         self.fixed_number_frames = fixed
         if not fixed:
             self.change_number_frames(self.get_number_lcm())
 
+    @in_transaction
     def change_number_frames(self, number_frames):
         if self.number_frames < number_frames:
             self.extend_frames(number_frames)
@@ -997,20 +2062,25 @@ class ImageManager:
         if self.ix_frame >= self.number_frames:
             self.ix_frame = self.number_frames - 1
 
+    @in_transaction
     def fix_size(self, fixed):
         self.fixed_size = fixed
         if not fixed:
             self.size = self.get_size_adjust()
 
+    @in_transaction
     def change_size(self, size):
         self.size = size
 
+    @in_transaction
     def set_duration_single(self, duration):
         self.duration_single = duration
 
+    @in_transaction
     def set_duration_multi(self, durations):
         self.durations_multi = durations
 
+    @in_transaction
     def set_filter(self, filter_color, filter_image):
         self.filter_color = filter_color
         self.filter_image = filter_image
@@ -1018,6 +2088,7 @@ class ImageManager:
             self.marked_selection = False
 
     # ソート
+    @in_transaction
     def sort_file(self, id_from, id_to):
         files = list(self.order_file.values())
         lst_id = [file.id_file for file in files]
@@ -1032,14 +2103,27 @@ class ImageManager:
 
         self.set_offset_base()
 
+    @in_transaction
     def sort_parts(self, num_frame, id_from, id_to):
         frame = self.order_frame[num_frame]
         frame.sort_parts(id_from, id_to)
 
-    # 合成、保存
-    def get_frames_composite(self):
-        frames_composite = [frame.composite_image(self.size, self.offset_base) for frame in
-                            self.order_frame]
+    # 保存用の複製 UIのスレッドで作り、保存のスレッドではこちらだけを使う
+    # パーツごと複製するため、保存中にプレビューの描画や操作でパーツやキャッシュが変わっても影響しない
+    @in_transaction
+    def create_snapshot(self):
+        return replace(self, dic_image={}, order_file={}, dic_file_children={}, selections=[],
+                       order_frame=[frame.create_snapshot() for frame in self.order_frame],
+                       durations_multi=self.durations_multi.copy(), interacting=False,
+                       state_transaction=None)
+
+    # 合成、保存 create_snapshotで作った複製に対して呼ぶ
+    def get_frames_composite(self, parallel=False):
+        if parallel and self.number_frames >= const.MIN_FRAMES_PARALLEL:
+            frames_composite = self.composite_frames_parallel()
+        else:
+            frames_composite = [frame.composite_image(self.size, self.offset_base) for frame in
+                                self.order_frame]
 
         if self.filter_image != const.ImageFilter.NONE:
             frames_composite = editor.filtering_image(frames_composite, self.filter_image)
@@ -1049,24 +2133,38 @@ class ImageManager:
 
         return frames_composite
 
+    # フレームごとの合成を別プロセスに振り分け、フレーム順に受け取る
+    def composite_frames_parallel(self):
+        count_worker = min(os.cpu_count() or 1, len(self.order_frame))
+        try:
+            with ProcessPoolExecutor(count_worker) as executor:
+                frames_composite = list(executor.map(composite_snapshot, self.order_frame,
+                                                     [self.size] * len(self.order_frame),
+                                                     [self.offset_base] * len(self.order_frame)))
+        except BrokenProcessPool:
+            frames_composite = [frame.composite_image(self.size, self.offset_base) for frame in
+                                self.order_frame]
+
+        return frames_composite
+
     def save_preview(self, is_single):
-        frames_composite = self.get_frames_composite()
+        frames_composite = self.get_frames_composite(parallel=True)
         image_chess = editor.create_chess_board(self.size, self.selected_file)
         frames_composite = [Image.alpha_composite(image_chess, frame) for frame in frames_composite]
         duration = self.duration_single if is_single else self.durations_multi
         editor.save_gif(const.PATH_GIF_PREVIEW, frames_composite, duration)
 
     def save_gif(self, path_save, is_single):
-        frames_composite = self.get_frames_composite()
+        frames_composite = self.get_frames_composite(parallel=True)
         duration = self.duration_single if is_single else self.durations_multi
         editor.save_gif(path_save, frames_composite, duration)
 
     def save_png_sequence(self, folder_save):
-        frames_composite = self.get_frames_composite()
+        frames_composite = self.get_frames_composite(parallel=True)
         editor.save_png_sequence(folder_save, frames_composite)
 
     def save_apng(self, path_save, is_single):
-        frames_composite = self.get_frames_composite()
+        frames_composite = self.get_frames_composite(parallel=True)
         duration = self.duration_single if is_single else self.durations_multi
         editor.save_apng(path_save, frames_composite, duration)
 
@@ -1111,6 +2209,12 @@ class ImageManager:
                        np.clip(height, const.MIN_HEIGHT, const.MAX_HEIGHT))
         return size_adjust
 
+    # 読込済みのファイルを全て手放す プロジェクトを読み込んで入れ替える時に使う
+    @in_transaction
+    def close(self):
+        for file in self.order_file.values():
+            file.close()
+
     def get_number_lcm(self):
         lst_count = list(set([file.number_frames for file in list(self.order_file.values())]))
         return np.lcm.reduce(lst_count) if lst_count else 1
@@ -1138,9 +2242,11 @@ class ImageManager:
 
         return file
 
-    def create_parts_image(self, file, im_parts, label):
+    def create_parts_image(self, file, im_parts, label, offset_trim=None):
         id_parts = self.issue_id_parts()
         parts = PartsImage(file.id_file, id_parts, file.type_image, label, im_parts)
+        offset_trim = file.get_offset_trim() if offset_trim is None else offset_trim
+        parts.offset_center = parts.offset_center + offset_trim
         self.dic_image[id_parts] = parts
         return parts
 
@@ -1175,3 +2281,8 @@ class ImageManager:
 
         for frame in self.order_frame:
             frame.convert_id2img(self.dic_image)
+
+
+# プロセスプールから呼ぶためモジュール直下に置く
+def composite_snapshot(frame, size, offset_base):
+    return frame.composite_image(size, offset_base)
@@ -8,11 +8,13 @@ import threading
 
 import const
 from config import CONFIG
+from image_manager import STORE_ICON
 import widgets
 import menus
 import wxlib
 
 import ctypes
+import multiprocessing
 
 
 class DropTarget(wx.FileDropTarget):
@@ -60,6 +62,8 @@ class MainFrame(wx.Frame):
         self.style = wx.ICON_INFORMATION
         self.path_open = None
         self.need_play = False
+        # 構成パネルに表示中の状態 変化がなければ作り直さない
+        self.state_component = None
 
         icon = wx.Icon(str(const.PATH_ICON))
         self.SetIcon(icon)
@@ -94,6 +98,8 @@ class MainFrame(wx.Frame):
         self.Bind(const.EVT_PLAY, self.on_play)
         self.Bind(wx.EVT_ACTIVATE, self.on_deactivate)
         self.Bind(wx.EVT_CLOSE, self.on_close)
+        # 画像プロパティの変更はtransaction単位でまとめて通知される
+        CONFIG.manager.add_listener(self.on_change)
 
         sizer_m = wx.BoxSizer()
         sizer_r = wx.BoxSizer(wx.VERTICAL)
@@ -141,20 +147,38 @@ class MainFrame(wx.Frame):
         wxlib.post_update(self, True, True, True)
 
     def on_update(self, event):
-        if event.reset:
+        preview, prop, component, reset, ids_changed = wxlib.take_update(self)
+        if reset:
+            STORE_ICON.clear()
             self.panel_component.reset_icon()
             self.panel_property.reset_icon()
 
-        if event.preview:
+        if preview:
             self.panel_preview.update_display()
 
-        if event.property:
+        if prop:
             self.panel_property.update_display()
 
-        if event.component:
+        # 変更されたファイル・パーツの行だけを書き換える 全体の更新があればそちらに任せる
+        if not component:
+            if ids_changed:
+                self.panel_component.update_rows(ids_changed)
+
+            return
+
+        state_component = CONFIG.manager.get_state_component()
+        if reset or state_component != self.state_component:
+            self.state_component = state_component
+            # 削除や置換で使われなくなったアイコンを捨て、イメージリストが作り直されたら一覧も作り直す
+            if not reset and STORE_ICON.prune(CONFIG.manager.get_icons()):
+                self.panel_component.reset_icon()
+
             self.panel_component.update_display()
             self.panel_composite.update_display()
 
+    def on_change(self, ids_changed):
+        wxlib.post_update(self, preview=True, ids_changed=ids_changed)
+
     def on_layout(self, event):
         self.sizer.Layout()
         self.panel.FitInside()
@@ -202,12 +226,14 @@ class MainFrame(wx.Frame):
     def on_play(self, event):
         wxlib.post_start_progress(self, "少しお待ちください…", "プレビュー作成中")
         is_single = self.panel_composite.radio_single.GetValue()
-        thread_preview = threading.Thread(target=self.save_preview, args=(is_single,), daemon=True)
+        manager = CONFIG.manager.create_snapshot()
+        thread_preview = threading.Thread(target=self.save_preview, args=(manager, is_single),
+                                          daemon=True)
         thread_preview.start()
 
-    def save_preview(self, is_single):
+    def save_preview(self, manager, is_single):
         with wxlib.progress_context(self, "プレビューの作成に失敗しました…", "プレビュー作成失敗"):
-            CONFIG.manager.save_preview(is_single)
+            manager.save_preview(is_single)
             wxlib.post_end_progress(self, need_play=True)
 
     # color_picker_dialogの位置調整
@@ -261,10 +287,13 @@ class WatchFilter(wx.EventFilter):
 
 
 if __name__ == '__main__':
+    # exe化した状態で保存時のプロセスプールを使うため
+    multiprocessing.freeze_support()
     PROCESS_PER_MONITOR_DPI_AWARE = 2
     ctypes.windll.shcore.SetProcessDpiAwareness(PROCESS_PER_MONITOR_DPI_AWARE)
     wx.DisableAsserts()
     app = wx.App()
+    wx.Font.AddPrivateFont(str(const.PATH_FONT_GENEI))
     name_instance = f"{app.GetAppName()}-{wx.GetUserId()}"
     instance = wx.SingleInstanceChecker(name_instance)
     if instance.IsAnotherRunning():
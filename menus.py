@@ -32,6 +32,10 @@ class MenuBar(wx.MenuBar):
         if not path_save:
             return
 
+        # 操作中の状態はUIのスレッドで終わらせてから保存のスレッドに渡す
+        if CONFIG.manager.end_interaction():
+            wxlib.post_update(self.GetParent(), preview=True)
+
         wxlib.post_start_progress(self.GetParent(), "少しお待ちください…", "プロジェクト保存中")
         thread_save = threading.Thread(target=self.save, args=(path_save,))
         thread_save.start()
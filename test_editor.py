@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageOps, ImageDraw
+
+import editor
+
+
+# 以前のPartsImage.edit_imageと同じ 反転→LANCZOSで拡大縮小→BICUBICで回転
+def transform_image_pil(im, zoom_x, zoom_y, angle, is_flip):
+    im_edit = ImageOps.mirror(im) if is_flip else im
+    size_zoom = (int(im_edit.width * zoom_x), int(im_edit.height * zoom_y))
+    im_edit = im_edit.resize(size_zoom, Image.LANCZOS)
+    return im_edit.rotate(angle, resample=Image.BICUBIC, expand=True)
+
+
+# 縁と内部に色と半透明がある検査用の画像
+def create_sample(size):
+    im = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(im)
+    width, height = size
+    draw.ellipse((width // 10, height // 8, width * 5 // 6, height * 9 // 10), fill=(200, 80, 40, 255))
+    draw.rectangle((width // 3, 0, width // 2, height // 2), fill=(30, 200, 90, 180))
+    draw.line((0, 0, width - 1, height - 1), fill=(10, 10, 250, 255), width=5)
+    return im
+
+
+def create_cases():
+    rng = np.random.default_rng(0)
+    lst_case = [(1, 1, 0, False), (1, 1, 0, True), (1, 1, 90, False), (1, 1, 180, True),
+                (1, 1, 270, False), (1, 1, -90, True), (0.5, 0.5, 90, False), (1.5, 0.7, 270, True),
+                (0.3, 0.3, 180, False), (1.5, 1.5, 0, False), (1, 1, 33, False), (2.3, 0.7, -17, True)]
+    for _ in range(12):
+        lst_case.append((float(rng.uniform(0.1, 3)), float(rng.uniform(0.1, 3)),
+                         int(rng.integers(-360, 360)), bool(rng.integers(2))))
+
+    return lst_case
+
+
+# 幅と高さの差が奇数・偶数・正方形のそれぞれで以前の変形と比べる
+@pytest.mark.parametrize("size", [(301, 217), (140, 91), (128, 128)])
+@pytest.mark.parametrize("zoom_x, zoom_y, angle, is_flip", create_cases())
+def test_transform_image_parity(size, zoom_x, zoom_y, angle, is_flip):
+    im = create_sample(size)
+    im_pil = transform_image_pil(im, zoom_x, zoom_y, angle, is_flip)
+    im_edit = editor.transform_image(im, zoom_x, zoom_y, angle, is_flip)
+    assert im_edit.size == im_pil.size
+
+    nd_pil = np.asarray(im_pil).astype(float)
+    nd_edit = np.asarray(im_edit).astype(float)
+    diff_alpha = np.abs(nd_pil[..., 3] - nd_edit[..., 3])
+    # 色はどちらもほぼ不透明な画素だけで比べる
+    mask = (nd_pil[..., 3] > 200) & (nd_edit[..., 3] > 200)
+    diff_color = np.abs(nd_pil[..., :3] - nd_edit[..., :3])[mask]
+
+    # 拡大縮小のない直角の回転と反転は画素まで一致する それ以外は縁の補間の違いだけ
+    if zoom_x == zoom_y == 1 and angle % 90 == 0:
+        assert not diff_alpha.any() and not diff_color.any()
+    else:
+        assert diff_alpha.mean() <= 4
+        assert diff_color.size == 0 or diff_color.mean() <= 4
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageSequence
+
+import const
+import editor
+from image_manager import CACHE_TRANSFORM, LazyFrames, PartsImage
+
+
+# 前のフレームの破棄方法が結果に効くよう、位置と大きさがフレームごとに変わるアニメーションを作る
+def create_animation(path_image):
+    frames = []
+    for ix in range(8):
+        im = Image.new("RGBA", (60, 40), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(im)
+        draw.ellipse((ix * 4, 5, 20 + ix * 4, 30), fill=(200, 30, 30, 255))
+        draw.rectangle((40, 0, 50, 10 + ix), fill=(0, 0, 255, 255))
+        frames.append(im)
+
+    if path_image.suffix == ".gif":
+        frames[0].save(path_image, save_all=True, append_images=frames[1:], disposal=2,
+                       transparency=0, loop=0)
+    else:
+        frames[0].save(path_image, save_all=True, append_images=frames[1:], disposal=1, blend=0,
+                       loop=0)
+
+
+@pytest.mark.parametrize("name", ["anime.png", "anime.gif"])
+def test_lazy_frames_out_of_order(tmp_path, name):
+    path_image = tmp_path / name
+    create_animation(path_image)
+    with Image.open(path_image) as im:
+        lst_expected = [np.asarray(frame.convert("RGBA")) for frame in ImageSequence.Iterator(im)]
+
+    # LRUを小さくして読み直しと戻る方向のseekを起こす
+    frames = LazyFrames(path_image, limit=2)
+    assert len(frames) == len(lst_expected)
+    for ix in [5, 2, 7, 0, 3, 3, 6, 1, -1]:
+        assert np.array_equal(np.asarray(frames[ix].convert("RGBA")), lst_expected[ix])
+
+    frames.close()
+
+
+def test_parts_draft_geometry():
+    CACHE_TRANSFORM.clear()
+    im = Image.fromarray(np.random.default_rng(0).integers(0, 256, (50, 70, 4), dtype=np.uint8),
+                         "RGBA")
+    parts = PartsImage("ID_FILE_0", "ID_PARTS_0", const.ImageType.BASE, "parts", im)
+    image_fine = editor.transform_image(im, 1, 1, 30, False)
+
+    # 操作中は低品質で変形し、操作が終わったら高品質で作り直す
+    parts.draft = True
+    parts.set_angle(30)
+    assert parts.get_image_edit().tobytes() == editor.transform_image(im, 1, 1, 30, False,
+                                                                       True).tobytes()
+    assert parts.is_draft_edit
+    parts.finish_draft()
+    assert parts.get_image_edit().tobytes() == image_fine.tobytes()
+    assert not parts.is_draft_edit
+
+    # 高品質の結果は操作中でもそのまま使う
+    parts.draft = True
+    parts.set_angle(30)
+    assert parts.get_image_edit().tobytes() == image_fine.tobytes()
+    assert not parts.is_draft_edit
+
+    # 補間が入らない変形は画質を問わないため作り直しも不要
+    parts.set_angle(90)
+    parts.get_image_edit()
+    assert not parts.is_draft_edit
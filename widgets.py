@@ -7,14 +7,16 @@ from wx.lib.agw.customtreectrl import (CustomTreeCtrl, TREE_ITEMTYPE_CHECK,
                                        TR_HAS_VARIABLE_ROW_HEIGHT,
                                        TR_DEFAULT_STYLE, TR_ELLIPSIZE_LONG_ITEMS,
                                        TR_TOOLTIP_ON_LONG_ITEMS,
-                                       EVT_TREE_ITEM_CHECKED)
+                                       EVT_TREE_ITEM_CHECKED, EVT_TREE_ITEM_EXPANDING)
 from wx.lib.statbmp import GenStaticBitmap
 
 import numpy as np
 import threading
+import traceback
 
 import const
 from config import CONFIG
+from image_manager import RenderCancelled, STORE_ICON
 import editor
 import menus
 import wxlib
@@ -237,9 +239,16 @@ class PreviewPanel(wx.Panel):
 
         self.pos_start = (0, 0)
         self.is_dragging = False
-        self.thread_loading = None
+        # 描画は常駐スレッド1本で行う 要求は1枠だけ持ち、新しい世代の要求が古いものを上書きする
+        self.generation = 0
+        self.generation_request = None
+        # 合成結果の書き込み先 表示は最新の世代だけなので描画スレッドと取り合うことはない
+        self.buffer_preview = None
+        self.condition_loading = threading.Condition()
+        self.thread_loading = threading.Thread(target=self.run_loading, daemon=True)
+        self.thread_loading.start()
         self.delay_update = wx.CallLater(self.DELAY_UPDATE, self.start_loading)
-        self.is_loading = False
+        self.delay_idle = wx.CallLater(const.DELAY_IDLE_RENDER, self.finish_interaction)
 
     def setting_widgets(self):
         self.panel_preview.SetMinSize(const.DEFAULT_SIZE)
@@ -267,14 +276,67 @@ class PreviewPanel(wx.Panel):
     def update_display(self):
         self.delay_update.Start(self.DELAY_UPDATE)
         self.panel_header.update_display()
+        # 操作が止まったら高品質で描画し直す
+        if CONFIG.manager.interacting:
+            self.delay_idle.Start(const.DELAY_IDLE_RENDER)
+
+    def finish_interaction(self):
+        if self.is_dragging:
+            return
+
+        if CONFIG.manager.end_interaction():
+            wxlib.post_update(self.GetTopLevelParent(), preview=True)
 
     def start_loading(self):
-        self.thread_loading = threading.Thread(target=self.load_frame, daemon=True)
-        self.thread_loading.start()
+        with self.condition_loading:
+            self.generation += 1
+            self.generation_request = self.generation
+            self.condition_loading.notify()
+
+    def run_loading(self):
+        while True:
+            with self.condition_loading:
+                while self.generation_request is None:
+                    self.condition_loading.wait()
+
+                generation = self.generation_request
+                self.generation_request = None
+
+            self.load_frame(generation)
+
+    # 描画中に新しい要求が来たらパーツの合間で打ち切る
+    # UIのスレッドの変更に譲って打ち切られた時は、まだ最新の要求なら変更の後で描き直す
+    def load_frame(self, generation):
+        def cancel():
+            return generation != self.generation
+
+        while True:
+            try:
+                image_preview = CONFIG.manager.get_preview(cancel, self.buffer_preview)
+                break
+            except RenderCancelled:
+                if cancel():
+                    return
+            # 失敗しても常駐スレッドは止めずに次の要求を待つ 原因が追えるよう例外の内容は出しておく
+            except Exception:
+                traceback.print_exc()
+                return
+
+        self.buffer_preview = image_preview
+        wx.CallAfter(self.display_frame, generation, image_preview)
+
+    # 最新の世代の結果だけを表示する
+    def display_frame(self, generation, image_preview):
+        if generation != self.generation:
+            return
+
+        # 同じサイズならビットマップも作り直さずに書き込む
+        if self.bmp_preview.IsOk() and self.bmp_preview.GetSize() == image_preview.size:
+            self.bmp_preview.CopyFromBuffer(image_preview.tobytes(), wx.BitmapBufferFormat_RGBA)
+        else:
+            self.bmp_preview = wx.Bitmap.FromBufferRGBA(*image_preview.size,
+                                                        image_preview.tobytes())
 
-    def load_frame(self):
-        image_preview = CONFIG.manager.get_preview()
-        self.bmp_preview = wx.Bitmap.FromBufferRGBA(*image_preview.size, image_preview.tobytes())
         self.panel_preview.SetMinSize(image_preview.size)
         self.show_frame()
 
@@ -316,16 +378,22 @@ class PreviewPanel(wx.Panel):
         pos_cur = np.array(event.GetPosition())
         offset = pos_cur - self.pos_start
         self.pos_start = pos_cur
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.add_offset(offset)
-        wxlib.post_update(self.GetTopLevelParent(), preview=True, prop=True)
+        wxlib.post_update(self.GetTopLevelParent(), prop=True)
 
+    # ドラッグを終えたら高品質で描画し直す
     def on_up(self, event):
         self.is_dragging = False
+        if CONFIG.manager.end_interaction():
+            wxlib.post_update(self.GetTopLevelParent(), preview=True)
 
     def on_enter(self, event):
         if self.is_dragging:
             if not event.LeftIsDown():
                 self.is_dragging = False
+                if CONFIG.manager.end_interaction():
+                    wxlib.post_update(self.GetTopLevelParent(), preview=True)
         else:
             self.sbmp_preview.SetFocus()
 
@@ -354,8 +422,9 @@ class PreviewPanel(wx.Panel):
             return
 
         direction = direction * 5 if event.ControlDown() else direction
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.add_offset(direction)
-        wxlib.post_update(self.GetTopLevelParent(), preview=True, prop=True)
+        wxlib.post_update(self.GetTopLevelParent(), prop=True)
 
     def on_wheel(self, event):
         if not CONFIG.manager.is_selected():
@@ -367,8 +436,9 @@ class PreviewPanel(wx.Panel):
 
         rate_angle = 10 if event.ControlDown() else 1
         angle_delta = -1 if 0 > event.GetWheelRotation() else 1
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.add_angle(angle_delta * rate_angle)
-        wxlib.post_update(self.GetTopLevelParent(), preview=True, prop=True)
+        wxlib.post_update(self.GetTopLevelParent(), prop=True)
 
     def play_animation(self):
         if self.anime_preview.IsPlaying():
@@ -397,7 +467,10 @@ class SelectionViewerPanel(ScrolledPanel):
         self.text_selected = wx.StaticText(self, -1, "未選択")
         self.sizer = wx.BoxSizer()
         self.sizer_icon = wx.BoxSizer()
-        self.create_icon(const.BMP_UNSELECTED)
+        # wxのビットマップはアプリ作成後でなければ作れないためconstではなくここで作る
+        self.bmp_unselected = wx.Bitmap.FromBufferRGBA(*const.BG_UNSELECTED.size,
+                                                       const.BG_UNSELECTED.tobytes())
+        self.create_icon(self.bmp_unselected)
 
         self.sizer.Add(self.sizer_icon, 0)
         self.sizer.Add(self.text_selected, 0, wx.LEFT | wx.ALIGN_CENTER_VERTICAL, 10)
@@ -428,7 +501,7 @@ class SelectionViewerPanel(ScrolledPanel):
                 continue
 
             if id_selection is None:
-                icon.set_bmp(const.BMP_UNSELECTED)
+                icon.set_bmp(self.bmp_unselected)
                 continue
 
             selection = CONFIG.manager.get_image(id_selection)
@@ -465,7 +538,7 @@ class SelectionViewerPanel(ScrolledPanel):
             icon.Destroy()
 
         self.lst_icon = self.lst_icon[:1]
-        self.lst_icon[0].set_bmp(const.BMP_UNSELECTED)
+        self.lst_icon[0].set_bmp(self.bmp_unselected)
         self.lst_id = [None]
 
 
@@ -597,37 +670,35 @@ class PropertyPanel(wx.Panel):
     def on_offset(self, event):
         self.panel_selection.SetFocus()
         offset = (self.spin_offset_x.GetValue(), self.spin_offset_y.GetValue())
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.set_offset(offset)
-        wxlib.post_update(self.GetTopLevelParent(), preview=True)
 
     def on_angle(self, event):
         self.panel_selection.SetFocus()
         angle = self.spin_angle.GetValue()
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.set_angle(angle)
-        wxlib.post_update(self.target_post, preview=True)
 
     def on_zoom(self, event):
         self.panel_selection.SetFocus()
         zoom_x = float(self.tc_zoom_x.GetValue())
         zoom_y = float(self.tc_zoom_y.GetValue())
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.set_zoom(zoom_x, zoom_y)
-        wxlib.post_update(self.target_post, preview=True)
 
     def on_trans(self, event):
         self.panel_selection.SetFocus()
         transparency = self.spin_trans.GetValue()
+        CONFIG.manager.begin_interaction()
         CONFIG.manager.set_transparency(transparency)
-        wxlib.post_update(self.target_post, preview=True)
 
     def on_alias(self, event):
         anti_alias = self.check_alias.GetValue()
         CONFIG.manager.set_alias(anti_alias)
-        wxlib.post_update(self.target_post, preview=True)
 
     def on_flip(self, event):
         is_flip = self.check_flip.GetValue()
         CONFIG.manager.set_flip(is_flip)
-        wxlib.post_update(self.target_post, preview=True)
 
     def on_color(self, event):
         self.panel_selection.SetFocus()
@@ -642,7 +713,6 @@ class PropertyPanel(wx.Panel):
         color_blend = self.ctrl_color.GetColour()[:-1]
         alpha_blend = float(self.tc_alpha.GetValue())
         CONFIG.manager.set_blend_color(mode_blend, color_blend, alpha_blend)
-        wxlib.post_update(self.target_post, preview=True)
         wxlib.post_layout(self.target_post)
 
     def update_display(self):
@@ -1003,12 +1073,13 @@ class PartsTreeCtrl(CustomTreeCtrl):
                          validator=wx.DefaultValidator,
                          name="CustomTreeCtrl")
         self.target_post = self.GetTopLevelParent()
-        self.imagelist = wx.ImageList(*const.ICON_SIZE)
-        self.order_il = []
-        self.SetImageList(self.imagelist)
+        self.SetImageList(STORE_ICON.get_imagelist())
 
         self.item_root = self.AddRoot("詳細構成")
         self.item_from = None
+        # 表示中のフレーム項目と、子を作成済みのフレームごとのパーツ表示状態
+        self.lst_item_frame = []
+        self.dic_state_children = {}
         self.accept_label = False
         self.label_prev = ""
 
@@ -1023,31 +1094,40 @@ class PartsTreeCtrl(CustomTreeCtrl):
         # self.Bind(wx.EVT_MIDDLE_DCLICK, self.on_middle)
         self.Bind(wx.EVT_TREE_END_LABEL_EDIT, self.on_label_end)
         self.Bind(EVT_TREE_ITEM_CHECKED, self.on_check)
+        self.Bind(EVT_TREE_ITEM_EXPANDING, self.on_expanding)
 
         font = wx.Font(8, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL,
                        faceName=const.FACE_FONT_GENEI, encoding=wx.FONTENCODING_DEFAULT)
         self.SetFont(font)
         self.SetBackgroundColour((255, 255, 255))
 
+    # 表示の更新 作り直さずに今の表示との差分だけを反映する
     def update_display(self):
-        item_selection = None
-        self.clear()
         order_frame = CONFIG.manager.get_order_frame()
-        self.update_imagelist(order_frame)
-        ix_selection = CONFIG.manager.ix_frame
-        for ix, frame in enumerate(order_frame):
+
+        # フレーム数の増減
+        while len(self.lst_item_frame) > len(order_frame):
+            self.Delete(self.lst_item_frame.pop())
+            self.dic_state_children.pop(len(self.lst_item_frame), None)
+
+        for ix in range(len(self.lst_item_frame), len(order_frame)):
             item_frame = self.AppendItem(self.item_root, f"フレーム【{ix + 1}】", data=ix)
-            for parts in frame.get_order_parts_display():
-                label = parts.label + "　" * (15 - len(parts.label))
-                item_parts = self.AppendItem(item_frame, label, data=parts.id_parts,
-                                             ct_type=TREE_ITEMTYPE_CHECK)
-                ix_icon = self.order_il.index(parts.id_parts)
-                self.SetItemImage(item_parts, ix_icon)
-                self.CheckItem2(item_parts, parts.visible)
-
-            if ix_selection == ix:
-                self.Expand(item_frame)
-                item_selection = item_frame
+            self.lst_item_frame.append(item_frame)
+
+        # 子を作成済みのフレームだけ更新する 未作成のフレームは展開された時に作る
+        for ix, (item_frame, frame) in enumerate(zip(self.lst_item_frame, order_frame)):
+            self.SetItemHasChildren(item_frame, bool(frame.order_parts))
+            if ix in self.dic_state_children:
+                self.update_children(ix)
+
+        ix_selection = CONFIG.manager.ix_frame
+        item_selection = None
+        if ix_selection < len(self.lst_item_frame):
+            item_selection = self.lst_item_frame[ix_selection]
+            if ix_selection not in self.dic_state_children:
+                self.update_children(ix_selection)
+
+            self.Expand(item_selection)
 
         self.Expand(self.item_root)
         if item_selection:
@@ -1057,9 +1137,83 @@ class PartsTreeCtrl(CustomTreeCtrl):
 
             self.SelectItem(item_selection, True)
 
+    def update_children(self, ix_frame):
+        item_frame = self.lst_item_frame[ix_frame]
+        frame = CONFIG.manager.get_order_frame()[ix_frame]
+        lst_target = [(parts.id_parts, self.get_state_row(parts))
+                      for parts in frame.get_order_parts_display()]
+        ids_target = [id_parts for id_parts, _ in lst_target]
+
+        children = self.get_children(item_frame)
+        ids_current = [self.GetItemData(child) for child in children]
+        lst_state = self.dic_state_children.get(ix_frame, [])
+
+        # 消えたパーツ
+        for ix in reversed(range(len(ids_current))):
+            if ids_current[ix] not in ids_target:
+                self.Delete(children.pop(ix))
+                ids_current.pop(ix)
+                lst_state.pop(ix)
+
+        for ix, (id_parts, state) in enumerate(lst_target):
+            if ix < len(ids_current) and ids_current[ix] == id_parts:
+                if lst_state[ix] != state:
+                    self.set_item_parts(children[ix], state)
+                    lst_state[ix] = state
+
+                continue
+
+            # 並び替えられたパーツは一旦消してから入れ直す
+            if id_parts in ids_current:
+                ix_prev = ids_current.index(id_parts)
+                self.Delete(children.pop(ix_prev))
+                ids_current.pop(ix_prev)
+                lst_state.pop(ix_prev)
+
+            label, visible, ix_icon = state
+            label = label + "　" * (15 - len(label))
+            item_parts = self.InsertItem(item_frame, ix, label, ct_type=TREE_ITEMTYPE_CHECK,
+                                         image=ix_icon, data=id_parts)
+            self.CheckItem2(item_parts, visible)
+            children.insert(ix, item_parts)
+            ids_current.insert(ix, id_parts)
+            lst_state.insert(ix, state)
+
+        self.dic_state_children[ix_frame] = lst_state
+
+    # 変更されたパーツの項目だけを書き換える 並びとフレーム数は変わらない前提
+    def update_rows(self, ids_changed):
+        for ix_frame, lst_state in self.dic_state_children.items():
+            for ix, item_parts in enumerate(self.get_children(self.lst_item_frame[ix_frame])):
+                id_parts = self.GetItemData(item_parts)
+                if id_parts not in ids_changed:
+                    continue
+
+                state = self.get_state_row(CONFIG.manager.get_image(id_parts))
+                if lst_state[ix] != state:
+                    self.set_item_parts(item_parts, state)
+                    lst_state[ix] = state
+
+    @staticmethod
+    def get_state_row(parts):
+        return parts.label, parts.visible, parts.get_ix_icon()
+
+    def set_item_parts(self, item_parts, state):
+        label, visible, ix_icon = state
+        self.SetItemText(item_parts, label + "　" * (15 - len(label)))
+        self.SetItemImage(item_parts, ix_icon)
+        self.CheckItem2(item_parts, visible)
+
+    def on_expanding(self, event):
+        ix_frame = self.GetItemData(event.GetItem())
+        if isinstance(ix_frame, int) and ix_frame not in self.dic_state_children:
+            self.update_children(ix_frame)
+
+        event.Skip()
+
+    # 共有イメージリストの番号が振り直されるため子を作り直す
     def reset_icon(self):
-        self.imagelist.RemoveAll()
-        self.order_il = []
+        self.clear()
 
     def get_lst_expanded(self):
         lst_expanded = [self.IsExpanded(child) for child in self.get_children(self.item_root)]
@@ -1071,21 +1225,10 @@ class PartsTreeCtrl(CustomTreeCtrl):
 
         return lst_expanded
 
-    def update_imagelist(self, order_frame):
-        lst_id_exists = [parts.id_parts for frame in order_frame for parts in frame]
-        lst_id_remove = list(set(self.order_il) - set(lst_id_exists))
-        for id_remove in lst_id_remove:
-            self.imagelist.Remove(self.order_il.index(id_remove))
-            self.order_il.remove(id_remove)
-
-        for frame in order_frame:
-            for parts in frame:
-                if parts.id_parts not in self.order_il:
-                    self.order_il.append(parts.id_parts)
-                    self.imagelist.Add(parts.get_bmp_icon())
-
     def clear(self):
         self.DeleteChildren(self.item_root)
+        self.lst_item_frame = []
+        self.dic_state_children = {}
 
     def on_drag(self, event):
         event.Allow()
@@ -1132,6 +1275,9 @@ class PartsTreeCtrl(CustomTreeCtrl):
         # frame
         if isinstance(self.GetItemData(id_item), int):
             ix_frame = self.GetItemData(id_item)
+            if ix_frame not in self.dic_state_children:
+                self.update_children(ix_frame)
+
             self.Expand(id_item)
             item_last = self.GetLastChild(id_item)
             if item_last:
@@ -1174,10 +1320,9 @@ class PartsTreeCtrl(CustomTreeCtrl):
         label_edit = event.GetLabel()
         id_item = event.GetItem()
         id_image = self.GetItemData(id_item)
+        # 一覧の書き換えは変更通知のidで行われる
         CONFIG.manager.set_label(id_image, label_edit)
 
-        wxlib.post_update(self.target_post, component=True)
-
     def on_right(self, event):
         id_item, flag = self.HitTest(event.GetPosition())
         if not flag & wx.TREE_HITTEST_ONITEM:
@@ -1229,9 +1374,9 @@ class FileListCtrl(wx.ListCtrl):
         self.EnableCheckBoxes(True)
         self.target_post = self.GetTopLevelParent()
         self.lst_data = []
-        self.imagelist = wx.ImageList(*const.ICON_SIZE)
-        self.order_il = []
-        self.SetImageList(self.imagelist, wx.IMAGE_LIST_SMALL)
+        # 各行の表示状態(ラベル, 表示, アイコン番号) lst_dataと同じ並び
+        self.lst_state = []
+        self.SetImageList(STORE_ICON.get_imagelist(), wx.IMAGE_LIST_SMALL)
 
         # click
         self.Bind(wx.EVT_LEFT_DOWN, self.on_left_down)
@@ -1262,37 +1407,70 @@ class FileListCtrl(wx.ListCtrl):
 
         self.SetFont(font)
 
-    # 表示の更新
+    # 表示の更新 作り直さずに今の表示との差分だけを反映する
     def update_display(self):
         order_file = CONFIG.manager.get_order_file_display()
-        self.update_imagelist(order_file)
-        self.ClearAll()
-        self.lst_data = []
+        lst_target = [(file.id_file, self.get_state_row(file)) for file in order_file]
+        ids_target = [id_file for id_file, _ in lst_target]
+
+        # 消えたファイル
+        for ix in reversed(range(len(self.lst_data))):
+            if self.lst_data[ix] not in ids_target:
+                self.delete_row(ix)
+
+        for ix, (id_file, state) in enumerate(lst_target):
+            if ix < len(self.lst_data) and self.lst_data[ix] == id_file:
+                if self.lst_state[ix] != state:
+                    self.set_row(ix, state)
+
+                continue
+
+            # 並び替えられたファイルは一旦消してから入れ直す
+            if id_file in self.lst_data:
+                self.delete_row(self.lst_data.index(id_file))
 
-        for ix, file in enumerate(order_file):
-            label = file.label + "　" * (15 - len(file.label))
-            item = self.InsertItem(ix, label, self.order_il.index(file.id_file))
-            self.lst_data.append(file.id_file)
-            self.accept_check = False
-            self.CheckItem(item, file.visible)
-            self.accept_check = True
-
-    def update_imagelist(self, order_file):
-        lst_id_exists = [file.id_file for file in order_file]
-        lst_id_remove = list(set(self.order_il) - set(lst_id_exists))
-        for id_remove in lst_id_remove:
-            self.imagelist.Remove(self.order_il.index(id_remove))
-            self.order_il.remove(id_remove)
-
-        for file in order_file:
-            if file.id_file not in self.order_il:
-                self.order_il.append(file.id_file)
-                self.imagelist.Add(file.get_bmp_icon())
+            label, visible, ix_icon = state
+            self.InsertItem(ix, label + "　" * (15 - len(label)), ix_icon)
+            self.lst_data.insert(ix, id_file)
+            self.lst_state.insert(ix, state)
+            self.check_row(ix, visible)
 
+    # 変更されたファイルの行だけを書き換える 並びは変わらない前提
+    def update_rows(self, ids_changed):
+        for ix, id_file in enumerate(self.lst_data):
+            if id_file not in ids_changed:
+                continue
+
+            state = self.get_state_row(CONFIG.manager.get_image(id_file))
+            if self.lst_state[ix] != state:
+                self.set_row(ix, state)
+
+    @staticmethod
+    def get_state_row(file):
+        return file.label, file.visible, file.get_ix_icon()
+
+    def set_row(self, ix, state):
+        label, visible, ix_icon = state
+        self.SetItemText(ix, label + "　" * (15 - len(label)))
+        self.SetItemImage(ix, ix_icon)
+        self.check_row(ix, visible)
+        self.lst_state[ix] = state
+
+    def delete_row(self, ix):
+        self.DeleteItem(ix)
+        self.lst_data.pop(ix)
+        self.lst_state.pop(ix)
+
+    def check_row(self, ix, visible):
+        self.accept_check = False
+        self.CheckItem(ix, visible)
+        self.accept_check = True
+
+    # 共有イメージリストの番号が振り直されるため行を作り直す
     def reset_icon(self):
+        self.DeleteAllItems()
         self.lst_data = []
-        self.imagelist.RemoveAll()
-        self.order_il = []
+        self.lst_state = []
 
     # パーツセレクト
     def on_left_down(self, event):
@@ -1371,7 +1549,7 @@ class FileListCtrl(wx.ListCtrl):
         is_checked = True if event.GetEventType() == wx.wxEVT_LIST_ITEM_CHECKED else False
         id_file = self.lst_data[ix_checked]
         CONFIG.manager.set_file_visible(id_file, is_checked)
-        wxlib.post_update(self.target_post, preview=True, component=True)
+        wxlib.post_update(self.target_post, preview=True)
 
     # ラベルの編集
     def on_label_begin(self, event):
@@ -1390,7 +1568,7 @@ class FileListCtrl(wx.ListCtrl):
         ix = event.GetIndex()
         id_image = self.lst_data[ix]
         CONFIG.manager.set_label(id_image, label_edit)
-        wxlib.post_update(self.target_post, prop=True, component=True)
+        wxlib.post_update(self.target_post, prop=True)
 
     def get_id_selected(self):
         ix_selected = self.GetFirstSelected()
@@ -1447,6 +1625,10 @@ class ComponentPanel(wx.Panel):
         self.flc.update_display()
         self.tree.update_display()
 
+    def update_rows(self, ids_changed):
+        self.flc.update_rows(ids_changed)
+        self.tree.update_rows(ids_changed)
+
     def reset_icon(self):
         self.flc.reset_icon()
         self.tree.reset_icon()
@@ -1746,13 +1928,14 @@ class CompositePanel(wx.Panel):
             return
 
         wxlib.post_start_progress(self.target_post, "少しお待ちください…", "保存中")
-        thread_gif = threading.Thread(target=self.thread_gif, args=(path_save,))
+        is_single = self.radio_single.GetValue()
+        manager = CONFIG.manager.create_snapshot()
+        thread_gif = threading.Thread(target=self.thread_gif, args=(manager, path_save, is_single))
         thread_gif.start()
 
-    def thread_gif(self, path_save):
+    def thread_gif(self, manager, path_save, is_single):
         with wxlib.progress_context(self.target_post, "保存に失敗しました…", "保存失敗"):
-            is_single = self.radio_single.GetValue()
-            CONFIG.manager.save_gif(path_save, is_single)
+            manager.save_gif(path_save, is_single)
             self.complete_save(path_save.parent)
 
     def save_png_sequence(self):
@@ -1761,12 +1944,13 @@ class CompositePanel(wx.Panel):
             return
 
         wxlib.post_start_progress(self.GetTopLevelParent(), "少しお待ちください…", "保存中")
-        thread_sequence = threading.Thread(target=self.thread_sequence, args=(folder_save,))
+        manager = CONFIG.manager.create_snapshot()
+        thread_sequence = threading.Thread(target=self.thread_sequence, args=(manager, folder_save))
         thread_sequence.start()
 
-    def thread_sequence(self, folder_save):
+    def thread_sequence(self, manager, folder_save):
         with wxlib.progress_context(self.target_post, "保存に失敗しました…", "保存失敗"):
-            CONFIG.manager.save_png_sequence(folder_save)
+            manager.save_png_sequence(folder_save)
             self.complete_save(folder_save)
 
     def save_apng(self):
@@ -1775,13 +1959,14 @@ class CompositePanel(wx.Panel):
             return
 
         wxlib.post_start_progress(self.GetTopLevelParent(), "少しお待ちください…", "保存中")
-        thread_apng = threading.Thread(target=self.thread_apng, args=(path_save,))
+        is_single = self.radio_single.GetValue()
+        manager = CONFIG.manager.create_snapshot()
+        thread_apng = threading.Thread(target=self.thread_apng, args=(manager, path_save, is_single))
         thread_apng.start()
 
-    def thread_apng(self, path_save):
+    def thread_apng(self, manager, path_save, is_single):
         with wxlib.progress_context(self.target_post, "保存に失敗しました…", "保存失敗"):
-            is_single = self.radio_single.GetValue()
-            CONFIG.manager.save_apng(path_save, is_single)
+            manager.save_apng(path_save, is_single)
             self.complete_save(path_save.parent)
 
     def complete_save(self, path_open):
@@ -1,5 +1,6 @@
 import wx
 import pathlib
+import threading
 
 from contextlib import contextmanager
 
@@ -41,9 +42,49 @@ def save_file(parent, caption, wildcard, name_save, style=wx.FD_SAVE | wx.FD_OVE
         return pathlib.Path(dial.GetPath())
 
 
+# EVT_UPDATEの合流 処理待ちのイベントがある間はフラグを足し込むだけにして1回の更新にまとめる
+# PostEventはイベントを複製して積むため、フラグはイベントではなくこちらで持つ
+class UpdateBus:
+    KEYS_FLAG = ("preview", "prop", "component", "reset")
+
+    def __init__(self):
+        self.dic_pending = {}
+        # 変更されたファイル・パーツのid フラグと一緒に溜めて一覧の該当行だけを書き換える
+        self.dic_ids_changed = {}
+        self.lock = threading.Lock()
+
+    def post(self, target_post, preview=False, prop=False, component=False, reset=False,
+             ids_changed=()):
+        with self.lock:
+            exists_pending = target_post in self.dic_pending
+            flags = self.dic_pending.setdefault(target_post, dict.fromkeys(self.KEYS_FLAG, False))
+            for key, flag in zip(self.KEYS_FLAG, (preview, prop, component, reset)):
+                flags[key] = flags[key] or flag
+
+            self.dic_ids_changed.setdefault(target_post, set()).update(ids_changed)
+
+        if not exists_pending:
+            wx.PostEvent(target_post, const.EVENT_UPDATE())
+
+    # 溜まったフラグと変更されたidを取り出す 以降の要求は次のイベントになる
+    def take(self, target_post):
+        with self.lock:
+            flags = self.dic_pending.pop(target_post, dict.fromkeys(self.KEYS_FLAG, False))
+            ids_changed = frozenset(self.dic_ids_changed.pop(target_post, ()))
+
+        return (*(flags[key] for key in self.KEYS_FLAG), ids_changed)
+
+
+BUS_UPDATE = UpdateBus()
+
+
 # post_event
-def post_update(target_post, preview=False, prop=False, component=False,reset=False):
-    wx.PostEvent(target_post, const.EVENT_UPDATE(preview=preview, property=prop, component=component,reset=reset))
+def post_update(target_post, preview=False, prop=False, component=False, reset=False, ids_changed=()):
+    BUS_UPDATE.post(target_post, preview, prop, component, reset, ids_changed)
+
+
+def take_update(target_post):
+    return BUS_UPDATE.take(target_post)
 
 
 def post_append(target_post, path_image, frames=None, id_replace=None):